@@ -4,10 +4,17 @@ clip.py: Embeddable, composable [c]ommand [l]ine [i]nterface [p]arsing
 Copyright: (c) 2015 William Gaul
 License: MIT, see LICENSE for more details
 '''
+import bisect
+import functools
 import itertools
+import os
+import re
 import shlex
 import sys
+import threading
+import time
 import uuid
+import weakref
 
 
 ########################################
@@ -19,6 +26,7 @@ PY2 = sys.version_info[0] == 2
 input = raw_input if PY2 else input
 text_type = basestring if PY2 else str
 to_str = lambda s: u'{}'.format(s)
+timer = getattr(time, 'perf_counter', time.time)
 def is_func(e):
 	return hasattr(e, '__call__')
 def iteritems(d):
@@ -48,6 +56,96 @@ def prompt_fn(f, s, default=None, type=None, skip=False, repeat=False):
 			if ret or not repeat:
 				return ret
 
+# Pieces of a command line as split by shlex.split() in POSIX mode: a plain
+# run of characters, a single-quoted string, a double-quoted string, an
+# escaped character, or whitespace between tokens
+_SHLEX_SPECIAL = re.compile(r'[\'"\\]')
+_SHLEX_PLAIN = re.compile(r'[^ \t\r\n]+')
+_SHLEX_PIECE = re.compile(r'([^ \t\r\n\'"\\]+)|\'([^\']*)\'|"([^"\\]*(?:\\.[^"\\]*)*)"|\\(.)|([ \t\r\n]+)', re.S)
+_SHLEX_DQ_ESCAPE = re.compile(r'\\(["\\])')
+
+def split(s):
+	'''Splits a command line exactly like shlex.split(), only much faster.
+
+	Lines that do not break down into the pieces above, such as those with
+	an unterminated quote, are handed off to shlex itself.
+	'''
+	if not _SHLEX_SPECIAL.search(s):
+		return _SHLEX_PLAIN.findall(s)
+	tokens = []
+	word = None
+	pos = 0
+	for m in _SHLEX_PIECE.finditer(s):
+		if m.start() != pos:
+			return shlex.split(s)
+		pos = m.end()
+		i = m.lastindex
+		if i == 5:
+			if word is not None:
+				tokens.append(word)
+				word = None
+			continue
+		piece = m.group(i)
+		if i == 3 and '\\' in piece:
+			piece = _SHLEX_DQ_ESCAPE.sub(r'\1', piece)
+		word = piece if word is None else word + piece
+	if pos != len(s):
+		return shlex.split(s)
+	if word is not None:
+		tokens.append(word)
+	return tokens
+
+def read_response_file(path):
+	'''Yields the tokens stored in a response file, one token per line.
+
+	The file is memory-mapped and scanned a line at a time, so it is never
+	read into memory as a single string. Blank lines are skipped.
+	'''
+	import mmap
+	try:
+		f = open(path, 'rb')
+	except (IOError, OSError):
+		exit('Error: Could not read response file "{}".'.format(path), True)
+	with f:
+		try:
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:  # Empty files cannot be mapped
+			return
+		try:
+			for line in iter(m.readline, b''):
+				line = line.rstrip(b'\r\n')
+				if line:
+					yield line.decode('utf-8')
+		finally:
+			m.close()
+
+def flatten_config(data, prefix=''):
+	'''Flattens nested config sections into a dict keyed by dotted path.
+	'''
+	flat = {}
+	for k, v in iteritems(data):
+		key = prefix + k
+		if isinstance(v, dict):
+			flat.update(flatten_config(v, key + '.'))
+		else:
+			flat[key] = v
+	return flat
+
+def load_config(path):
+	'''Parses a JSON (*.json) or INI config file into a flat dict.
+	'''
+	if path.endswith('.json'):
+		import json
+		with open(path) as f:
+			return flatten_config(json.load(f))
+	try:
+		import configparser
+	except ImportError:
+		import ConfigParser as configparser
+	parser = configparser.RawConfigParser()
+	parser.read(path)
+	return flatten_config({s: dict(parser.items(s)) for s in parser.sections()})
+
 def determine_type(t, default):
 	if t is None:
 		if default is not None:
@@ -57,6 +155,155 @@ def determine_type(t, default):
 		return None
 	return t
 
+def edit_distance(a, b, limit=None):
+	'''Returns the Levenshtein distance between two strings.
+
+	If limit is given, gives up as soon as the distance must be greater than
+	limit, and returns limit + 1 instead.
+	'''
+	if len(a) < len(b):
+		a, b = b, a
+	if limit is not None and len(a) - len(b) > limit:
+		return limit + 1
+	previous = list(range(len(b) + 1))
+	for i, ca in enumerate(a, 1):
+		current = [i]
+		for j, cb in enumerate(b, 1):
+			current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+		if limit is not None and min(current) > limit:
+			return limit + 1
+		previous = current
+	return previous[-1]
+
+class _NgramIndex(object):
+	'''An index of words for finding the one closest to a word by edit
+	distance, without comparing it against all of them.
+
+	Words are indexed by their n-grams. A single edit changes at most n of
+	a word's n-grams, so words sharing few n-grams with the word looked up
+	cannot be close to it and are never compared.
+	'''
+
+	def __init__(self, words, n=3):
+		self._n = n
+		self._words = sorted(set(words))
+		self._postings = {}  # n-gram --> indices of the words containing it
+		for i, word in enumerate(self._words):
+			for gram in self._grams(word):
+				self._postings.setdefault(gram, []).append(i)
+
+	def _grams(self, word):
+		padded = '\0' * (self._n - 1) + word + '\0' * (self._n - 1)
+		return set(padded[i:i + self._n] for i in range(len(word) + self._n - 1))
+
+	def closest(self, word, max_distance):
+		'''Returns the closest word within max_distance (the first in sorted
+		order if there is a tie), or None.
+		'''
+		grams = self._grams(word)
+		shared = {}
+		for gram in grams:
+			for i in self._postings.get(gram, ()):
+				shared[i] = shared.get(i, 0) + 1
+		candidates = sorted(iteritems(shared), key=lambda e: (-e[1], e[0]))
+		if -(-len(grams) // self._n) <= max_distance:
+			# Even words sharing no n-grams could be close enough
+			candidates += [(i, 0) for i in range(len(self._words)) if i not in shared]
+		best = (max_distance + 1, None)
+		for i, count in candidates:
+			if (len(grams) - count) > self._n * best[0]:
+				break  # Every remaining word is further away than the best
+			d = edit_distance(word, self._words[i], best[0])
+			if d < best[0] or (d == best[0] and best[1] is not None and self._words[i] < best[1]):
+				best = (d, self._words[i])
+		return best[1]
+
+def _deep_sizeof(obj, seen):
+	'''Returns the size in bytes of obj and everything it holds, leaving out
+	objects in seen (and adding the rest to it). Functions and other callables
+	(including Commands), as well as Apps, are not counted or followed.
+	'''
+	size = 0
+	stack = [obj]
+	while stack:
+		o = stack.pop()
+		if id(o) in seen or is_func(o) or isinstance(o, App):
+			continue
+		seen.add(id(o))
+		size += sys.getsizeof(o)
+		if isinstance(o, dict):
+			stack.extend(o.keys())
+			stack.extend(o.values())
+		elif isinstance(o, (list, tuple, set, frozenset)):
+			stack.extend(o)
+		elif hasattr(o, '__dict__'):
+			stack.append(o.__dict__)
+	return size
+
+class _InvalidValue(ValueError):
+	pass
+
+_converters = {}  # Compiled converters, shared by parameters with the same spec
+
+def compile_converter(type=None, choices=None, min=None, max=None, path_exists=False,
+                      stat_cache=None):
+	'''Returns a single function that converts a token to the given type and
+	checks it against the given constraints, raising ValueError if it fails.
+
+	Checks are resolved here instead of on every token: choices become a
+	frozenset, and only the checks that apply are chained. With stat_cache,
+	whether a path exists is remembered for that many seconds. Converters
+	are cached, so this returns the same function for the same arguments.
+	'''
+	if choices is not None:
+		choices = frozenset(choices)
+	key = (type, choices, min, max, path_exists, stat_cache)
+	try:
+		return _converters[key]
+	except KeyError:
+		pass
+	convert = type
+	checks = []
+	if choices is not None:
+		expected = 'expected one of {}'.format(', '.join(sorted(to_str(e) for e in choices)))
+		def check_choices(v):
+			if v not in choices:
+				raise _InvalidValue(expected)
+		checks.append(check_choices)
+	if min is not None:
+		def check_min(v):
+			if v < min:
+				raise _InvalidValue('expected at least {}'.format(min))
+		checks.append(check_min)
+	if max is not None:
+		def check_max(v):
+			if v > max:
+				raise _InvalidValue('expected at most {}'.format(max))
+		checks.append(check_max)
+	if path_exists:
+		exists = os.path.exists
+		if stat_cache is not None:
+			cache = {}
+			def exists(path):
+				now = timer()
+				hit = cache.get(path)
+				if hit is None or now >= hit[1]:
+					hit = cache[path] = (os.path.exists(path), now + stat_cache)
+				return hit[0]
+		def check_path(v):
+			if not exists(v):
+				raise _InvalidValue('"{}" does not exist'.format(v))
+		checks.append(check_path)
+	if checks:
+		def convert(v, convert=convert):
+			if convert is not None:
+				v = convert(v)
+			for check in checks:
+				check(v)
+			return v
+	_converters[key] = convert
+	return convert
+
 
 ########################################
 # GLOBAL CLASSES/METHODS
@@ -66,6 +313,9 @@ class ClipGlobals(object):
 
 	def __init__(self):
 		self._streams = {}
+		self._apps = weakref.WeakValueDictionary()  # Live apps, by name
+		self._answers = None  # Scripted answers used by prompt() and confirm()
+		self._local = threading.local()  # Per-thread app that echo() defaults to
 
 	def _write(self, message, stream, nl=True):
 		stream.write(to_str(message) + ("\n" if nl else ""))
@@ -73,18 +323,83 @@ class ClipGlobals(object):
 		if hasattr(stream, 'flush'):
 			stream.flush()
 
+	def _write_lines(self, lines, streams, chunk_size):
+		lines = iter(lines)
+		# Custom streams may only implement a write() method
+		writers = [getattr(s, 'writelines', None) or (lambda c, s=s: s.write(''.join(c))) for s in streams]
+		while True:
+			chunk = [u'{}\n'.format(e) for e in itertools.islice(lines, chunk_size)]
+			if not chunk:
+				break
+			for w in writers:
+				w(chunk)
+		for stream in streams:
+			if hasattr(stream, 'flush'):
+				stream.flush()
+
 	def _broadcast(self, message, err=False, nl=True):
 		for k, v in iteritems(self._streams):
 			self._write(message, v['err' if err else 'out'], nl)
 
 	def echo(self, message, err=False, nl=True, app=None):
+		buffer = getattr(self._local, 'buffer', None)
+		if buffer is not None:
+			buffer.append((to_str(message), err, nl, app))
+			return
 		if not self._streams:
 			raise AttributeError('No streams have been initialized')
+		if app is None:
+			app = getattr(self._local, 'app', None)
 		if app is None:
 			self._broadcast(message, err, nl)
 		else:
 			self._write(message, self._streams[app]['err' if err else 'out'], nl)
 
+	def echo_lines(self, lines, err=False, app=None, chunk_size=1024):
+		buffer = getattr(self._local, 'buffer', None)
+		if buffer is not None:
+			buffer.extend((to_str(e), err, True, app) for e in lines)
+			return
+		self._write_lines(lines, self._get_streams(err, app), chunk_size)
+
+	def _get_streams(self, err=False, app=None):
+		if not self._streams:
+			raise AttributeError('No streams have been initialized')
+		buffer = getattr(self._local, 'buffer', None)
+		if buffer is not None:
+			return [_BufferStream(buffer, err)]
+		key = 'err' if err else 'out'
+		if app is None:
+			app = getattr(self._local, 'app', None)
+		if app is None:
+			return [v[key] for v in self._streams.values()]
+		return [self._streams[app][key]]
+
+	def _scope(self, app):
+		'''Makes echo() without an app write only to the given app's streams,
+		until the returned scope is closed. Scopes are per-thread.
+		'''
+		return _EchoScope(self._local, app)
+
+	def _capture(self, f, *args):
+		'''Calls f, holding back everything it echoes on this thread.
+
+		Returns the held back echoes, the exit status, and an error message
+		for exceptions other than ClipExit. Everything returned can be pickled,
+		so this may also run in another process.
+		'''
+		buffer = self._local.buffer = []
+		status, error = 0, None
+		try:
+			f(*args)
+		except ClipExit as e:
+			status = e.status
+		except Exception as e:
+			status, error = 1, '{}: {}'.format(type(e).__name__, e)
+		finally:
+			self._local.buffer = None
+		return buffer, status, error
+
 	def add_streams(self, out, err, app=None):
 		self._streams[app] = {
 			'out': out or sys.stdout,
@@ -92,6 +407,137 @@ class ClipGlobals(object):
 		}
 
 
+class _BufferStream(object):
+	'''Writes into a buffer held by ClipGlobals, for code that needs streams.
+	'''
+
+	def __init__(self, buffer, err):
+		self._buffer = buffer
+		self._err = err
+
+	def write(self, message):
+		self._buffer.append((message, self._err, False, None))
+
+
+class _CountingStream(object):
+	'''Wraps a stream, counting the bytes (in UTF-8) written to it.
+	'''
+
+	def __init__(self, stream):
+		self._stream = stream
+		self.count = 0
+
+	def write(self, message):
+		self.count += len(message.encode('utf-8'))
+		self._stream.write(message)
+
+	def flush(self):
+		if hasattr(self._stream, 'flush'):
+			self._stream.flush()
+
+	def isatty(self):
+		return hasattr(self._stream, 'isatty') and self._stream.isatty()
+
+
+# Parse errors are counted by reason, told apart by how their message starts
+_PARSE_ERROR_REASONS = [
+	('Error: Could not understand', 'unknown_token'),
+	('Error: Missing parameter', 'missing_parameter'),
+	('Error: Not enough arguments', 'not_enough_arguments'),
+	('Error: Invalid type', 'invalid_type'),
+	('Error: Invalid value', 'invalid_value'),
+	('Error: Could not read response file', 'response_file')
+]
+
+def _parse_error_reason(message):
+	message = to_str(message)
+	for prefix, reason in _PARSE_ERROR_REASONS:
+		if message.startswith(prefix):
+			return reason
+	return 'other'
+
+def _count_request(counts, command):
+	path = ' '.join(command._get_path())
+	counts[path] = counts.get(path, 0) + 1
+
+def _prometheus_label(value):
+	return to_str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _EchoScope(object):
+
+	def __init__(self, local, app):
+		self._local = local
+		self._app = app
+
+	def __enter__(self):
+		self._previous = getattr(self._local, 'app', None)
+		self._local.app = self._app
+
+	def __exit__(self, *exc_info):
+		self._local.app = self._previous
+
+
+class Answers(object):
+	'''Scripted answers to prompt() and confirm(), for unattended runs.
+
+	The source may be a dict mapping prompt text to an answer (or to a list
+	of answers, given out in order), the path to a JSON or YAML file holding
+	such a dict, or any other iterable of answers given out in order.
+	'''
+
+	def __init__(self, source):
+		if isinstance(source, text_type):
+			source = self._load(source)
+		if isinstance(source, dict):
+			self._map = {k: iter(v) if isinstance(v, list) else v for k, v in iteritems(source)}
+			self._sequence = None
+		else:
+			self._map = None
+			self._sequence = iter(source)
+
+	def _load(self, path):
+		with open(path) as f:
+			if path.endswith(('.yml', '.yaml')):
+				try:
+					import yaml
+				except ImportError:
+					raise ImportError('PyYAML is required to read answers from {}'.format(path))
+				return yaml.safe_load(f)
+			import json
+			return json.load(f)
+
+	def get(self, text):
+		'''Returns the next answer to the prompt with the given text.
+		'''
+		answer = None
+		if self._sequence is not None:
+			answer = next(self._sequence, None)
+		elif text in self._map:
+			answer = self._map[text]
+			if hasattr(answer, '__next__') or hasattr(answer, 'next'):
+				answer = next(answer, None)
+		if answer is None:
+			exit('Error: No scripted answer for prompt "{}".'.format(text), True)
+		if isinstance(answer, bool):  # YAML parses yes/no as booleans
+			return 'yes' if answer else 'no'
+		return to_str(answer)
+
+	def input_function(self, text):
+		'''Returns an input function that answers the prompt with the given text.
+
+		A scripted answer cannot be corrected, so if the function is called a
+		second time the first answer was rejected and we fail immediately.
+		'''
+		asked = []
+		def f(_):
+			if asked:
+				exit('Error: Invalid scripted answer for prompt "{}".'.format(text), True)
+			asked.append(True)
+			return self.get(text)
+		return f
+
+
 class ClipExit(Exception):
 	def __init__(self, message=None, status=0):
 		self.message = message or 'clip exiting with status {}'.format(status)
@@ -100,20 +546,286 @@ class ClipExit(Exception):
 		return repr(self.message)
 
 
+TIMEOUT_STATUS = 124  # Exit status of a command that timed out
+
+
+class CancelToken(object):
+	'''Tells a running callback that it should stop, e.g. because it timed
+	out. Callbacks are not interrupted, so they should poll clip.cancelled()
+	and return early. A token is also cancelled once its parent is.
+	'''
+
+	def __init__(self, parent=None):
+		self._parent = parent
+		self._event = threading.Event()
+
+	def cancel(self):
+		self._event.set()
+
+	def cancelled(self):
+		return self._event.is_set() or (self._parent is not None and self._parent.cancelled())
+
+
+def _call_with_timeout(f, arg, timeout, what, app=None):
+	'''Calls f(arg) in a worker thread, and gives up on it after timeout
+	seconds by cancelling its token and exiting with TIMEOUT_STATUS.
+	'''
+	local = clip_globals._local
+	scope = tuple(getattr(local, e, None) for e in ('app', 'buffer', 'answers'))
+	token = CancelToken(getattr(local, 'token', None))
+	raised = []
+
+	def target():
+		local.app, local.buffer, local.answers = scope
+		local.token = token
+		try:
+			f(arg)
+		except BaseException as e:
+			raised.append(e)
+
+	worker = threading.Thread(target=target)
+	worker.daemon = True  # Don't keep the program alive for a runaway callback
+	worker.start()
+	worker.join(timeout)
+	if worker.is_alive():
+		token.cancel()
+		message = 'Error: {} timed out after {}s.'.format(what, timeout)
+		echo(message, True, app=app)
+		raise ClipExit(message, TIMEOUT_STATUS)
+	if raised:
+		raise raised[0]
+
+
 clip_globals = ClipGlobals()
 
 def echo(message, err=False, nl=True, app=None):
 	clip_globals.echo(message, err, nl, app)
 
+def echo_lines(lines, err=False, app=None, chunk_size=1024):
+	'''Echoes every item of an iterable on its own line.
+
+	This is much faster than calling echo() in a loop: lines are written
+	in chunks of chunk_size, and the streams are flushed only once at the end.
+	'''
+	clip_globals.echo_lines(lines, err, app, chunk_size)
+
+class CaptureStream(object):
+	'''An in-memory stream that keeps everything written to it.
+
+	Writes are appended to a list as-is, and only joined (once) when the
+	value is asked for, so capturing costs about as much as a list append.
+	'''
+
+	def __init__(self):
+		self._parts = []
+		self.write = self._parts.append  # Skip a method call on every write
+
+	def __getstate__(self):
+		return {'_parts': self._parts}
+
+	def __setstate__(self, state):
+		self._parts = state['_parts']
+		self.write = self._parts.append
+
+	def getvalue(self):
+		if len(self._parts) > 1:
+			self._parts[:] = [u''.join(self._parts)]
+		return self._parts[0] if self._parts else u''
+
+	def clear(self):
+		del self._parts[:]
+
+	def flush(self):
+		pass
+
+
+class RingStream(object):
+	'''An in-memory stream that keeps only the last max_bytes written to it.
+
+	Output is kept in a ring buffer allocated up front, so memory stays
+	bounded however chatty a command is. Writes are gathered in a list and
+	only encoded into the buffer once they add up to max_bytes characters.
+	Once older output has been dropped, truncated is True and dropped holds
+	the number of bytes lost.
+	'''
+
+	def __init__(self, max_bytes=65536, encoding='utf-8'):
+		if max_bytes <= 0:
+			raise ValueError('max_bytes must be positive')
+		self._buffer = bytearray(max_bytes)
+		self._view = memoryview(self._buffer)  # Much faster slice assignment
+		self._max = max_bytes
+		self._encoding = encoding
+		self._end = 0  # Where the next write into the buffer starts
+		self._written = 0  # Bytes written into the buffer in total
+		self._pending = []  # Writes not yet encoded into the buffer
+		self._pending_size = 0
+
+	def write(self, message):
+		if len(message) > self._max:
+			# Every character takes at least a byte, so only the last max_bytes
+			# characters can be kept; the rest is counted but never copied whole
+			cut = len(message) - self._max
+			self._written += self._encoded_size(message, cut)
+			message = message[cut:]
+		self._pending.append(message)
+		self._pending_size += len(message)
+		if self._pending_size >= self._max:
+			self._compact()
+
+	def _encoded_size(self, message, end):
+		# The encoded size of message[:end], encoded a piece at a time
+		import codecs
+		encoder = codecs.getincrementalencoder(self._encoding)()
+		return sum(len(encoder.encode(message[i:min(i + self._max, end)]))
+		           for i in range(0, end, self._max))
+
+	def _compact(self):
+		data = u''.join(self._pending).encode(self._encoding)
+		del self._pending[:]
+		self._pending_size = 0
+		n = len(data)
+		self._written += n
+		if n >= self._max:
+			self._view[:] = data[n - self._max:]
+			self._end = 0
+			return
+		end = self._end
+		first = min(n, self._max - end)
+		self._view[end:end + first] = data[:first]
+		if first < n:
+			self._view[:n - first] = data[first:]
+		self._end = (end + n) % self._max
+
+	@property
+	def truncated(self):
+		self._compact()
+		return self._written > self._max
+
+	@property
+	def dropped(self):
+		self._compact()
+		return max(0, self._written - self._max)
+
+	def getvalue(self):
+		if not self.truncated:
+			return self._buffer[:self._written].decode(self._encoding, 'replace')
+		data = self._buffer[self._end:] + self._buffer[:self._end]
+		# Don't start with the tail end of a character that was cut in half
+		start = 0
+		while start < len(data) and data[start] & 0xC0 == 0x80:
+			start += 1
+		return data[start:].decode(self._encoding, 'replace')
+
+	def clear(self):
+		del self._pending[:]
+		self._pending_size = 0
+		self._end = 0
+		self._written = 0
+
+	def flush(self):
+		pass
+
+
+class Status(object):
+	'''A line of status output that is redrawn in place.
+
+	Redraws are throttled to one every interval seconds. Streams that are not
+	a TTY cannot be redrawn, so there each update is printed on its own line,
+	at most once every summary_interval seconds.
+	'''
+
+	def __init__(self, app=None, err=True, interval=0.1, summary_interval=5.0):
+		self._streams = clip_globals._get_streams(err, app)
+		self._tty = all(hasattr(s, 'isatty') and s.isatty() for s in self._streams)
+		self._interval = interval if self._tty else summary_interval
+		self._deadline = 0  # Earliest time of the next redraw
+		self._width = 0  # Length of the line currently drawn
+		self._message = None  # Last message seen, drawn or not
+
+	def update(self, message, force=False):
+		'''Updates the status line, redrawing it if enough time has passed.
+		'''
+		self._message = message
+		now = timer()
+		if force or now >= self._deadline:
+			self._deadline = now + self._interval
+			self._draw(message)
+
+	def _draw(self, message):
+		message = to_str(message)
+		if self._tty:
+			line = u'\r{}{}'.format(message, ' ' * (self._width - len(message)))
+			self._width = len(message)
+		else:
+			line = message + '\n'
+		for stream in self._streams:
+			clip_globals._write(line, stream, nl=False)
+
+	def done(self, message=None):
+		'''Draws the final status and ends the status line.
+		'''
+		message = self._message if message is None else message
+		if message is not None:
+			self._draw(message)
+		if self._tty and self._width:
+			for stream in self._streams:
+				clip_globals._write('', stream)
+
+
+def progress(iterable, label=None, length=None, app=None, err=True,
+             interval=0.1, summary_interval=5.0):
+	'''Yields the items of an iterable while showing a progress status line.
+
+	If length is not given, it is taken from len(iterable) when possible.
+	'''
+	if length is None and hasattr(iterable, '__len__'):
+		length = len(iterable)
+	prefix = '' if label is None else '{}: '.format(label)
+	if length:
+		fmt = lambda i: '{}{}/{} ({}%)'.format(prefix, i, length, 100 * i // length)
+	else:
+		fmt = lambda i: '{}{}'.format(prefix, i)
+	status = Status(app, err, interval, summary_interval)
+	i = 0
+	try:
+		for i, item in enumerate(iterable, 1):
+			yield item
+			if timer() >= status._deadline:
+				status.update(fmt(i), force=True)
+	finally:
+		# Also when the loop is left early, so the status line is finished
+		status.done(fmt(i))
+
 def exit(message=None, err=False, app=None):
 	if message:
 		echo(message, err, app=app)
 	raise ClipExit(message, 1 if err else 0)
 
+def cancelled():
+	'''Returns True if the running callback has been cancelled.
+	'''
+	token = getattr(clip_globals._local, 'token', None)
+	return token is not None and token.cancelled()
+
 def raise_abort():
 	exit('Operation aborted by user', True)
 
-def confirm(prompt, default=None, show_default=True, abort=False, input_function=None):
+def set_answers(source):
+	'''Answers all following prompts from a script instead of the user.
+
+	See Answers for the accepted sources. Pass None to go back to prompting.
+	'''
+	clip_globals._answers = None if source is None else Answers(source)
+
+def get_answers(answers=None):
+	if answers is None:
+		answers = getattr(clip_globals._local, 'answers', None)
+		return clip_globals._answers if answers is None else answers
+	return answers if isinstance(answers, Answers) else Answers(answers)
+
+def confirm(prompt, default=None, show_default=True, abort=False, input_function=None,
+            answers=None):
 	'''Prompts for confirmation from the user.
 	'''
 	valid = {
@@ -122,6 +834,10 @@ def confirm(prompt, default=None, show_default=True, abort=False, input_function
 		'no': False,
 		'n': False
 	}
+	# Answers given to this call win, but set ones don't replace an input_function
+	answers = get_answers(answers) if answers is not None or input_function is None else None
+	if answers is not None:
+		input_function = answers.input_function(prompt)
 	input_function = get_input_fn(input_function)
 	if default not in ['yes', 'no', None]:
 		default = None
@@ -139,10 +855,16 @@ def confirm(prompt, default=None, show_default=True, abort=False, input_function
 			echo('Please respond with "yes" or "no" (or "y" or "n").')
 
 def prompt(text, default=None, show_default=True, invisible=False,
-           confirm=False, skip=False, type=None, input_function=None):
+           confirm=False, skip=False, type=None, input_function=None,
+           answers=None):
 	'''Prompts for input from the user.
 	'''
 	t = determine_type(type, default)
+	# Answers given to this call win, but set ones don't replace an input_function
+	answers = get_answers(answers) if answers is not None or input_function is None else None
+	if answers is not None:
+		input_function = answers.input_function(text)
+		confirm = False  # There is nobody to confirm a scripted answer
 	input_function = get_input_fn(input_function, invisible)
 	if default is not None and show_default:
 		text = '{} [{}]: '.format(text, default)
@@ -155,6 +877,123 @@ def prompt(text, default=None, show_default=True, invisible=False,
 		echo('Error: The two values you entered do not match', True)
 
 
+########################################
+# TOKEN STREAM
+########################################
+
+_END = object()  # Returned by TokenStream.peek() once all tokens are consumed
+
+def is_globbed(s):
+	return len(s) > 2 and s[0] == '-' and s[1] != '-'
+
+
+class TokenStream(object):
+	'''A cursor over the tokens being parsed.
+
+	Tokens are pulled from the source iterable one at a time and nothing is
+	copied or allocated for plain tokens. A globbed option (-abc) is left
+	as-is until the parser decides how to split it.
+	'''
+
+	def __init__(self, tokens):
+		self._source = iter(tokens)
+		self._ahead = []  # Tokens already split or expanded, in reverse order
+		self._raw = _END  # The next token from the source, if it has been peeked
+
+	def peek(self):
+		'''Returns the next token without consuming it, or _END if there is none.
+		'''
+		if self._ahead:
+			return self._ahead[-1]
+		if self._raw is _END:
+			self._raw = next(self._source, _END)
+		return self._raw
+
+	def globbed(self):
+		'''Whether the next token is a globbed option that is not yet expanded.
+		'''
+		return not self._ahead and self.peek() is not _END and is_globbed(self._raw)
+
+	def expand(self):
+		'''Expands the next token if it is globbed: -abc --> -a -b -c
+		'''
+		self.peek()
+		if self.globbed():
+			self._ahead.extend('-' + c for c in reversed(self._raw[1:]))
+			self._raw = _END
+
+	def split(self, *parts):
+		'''Replaces the next token with the given parts, which are never expanded.
+		'''
+		if self._ahead:
+			self._ahead.pop()
+		else:
+			self._raw = _END
+		self._ahead.extend(reversed(parts))
+
+	def next(self):
+		'''Consumes and returns the next token, expanding it if it is globbed.
+		'''
+		if self._ahead:
+			return self._ahead.pop()
+		token = self._raw if self._raw is not _END else next(self._source, _END)
+		self._raw = _END
+		if token is not _END and is_globbed(token):
+			self._ahead.extend('-' + c for c in reversed(token[2:]))
+			return '-' + token[1]
+		return token
+
+	def take(self, n):
+		'''Consumes the next n tokens, or returns None if there are not enough.
+		'''
+		taken = []
+		for _ in range(n):
+			token = self.next()
+			if token is _END:
+				return None
+			taken.append(token)
+		return taken
+
+	def take_all(self):
+		'''Consumes all remaining tokens.
+		'''
+		taken = []
+		while self._ahead or self._raw is not _END:
+			taken.append(self.next())
+		for token in self._source:
+			if len(token) > 2 and token[0] == '-' and token[1] != '-':
+				taken.extend('-' + c for c in token[1:])
+			else:
+				taken.append(token)
+		return taken
+
+	def __bool__(self):
+		return self.peek() is not _END
+	__nonzero__ = __bool__
+
+	# Parameter.consume() used to receive a plain list of tokens. The methods
+	# below keep extensions written against that interface working.
+
+	def pop(self, index=0):
+		if index != 0:
+			raise IndexError('Tokens can only be popped from the front')
+		token = self.next()
+		if token is _END:
+			raise IndexError('pop from empty token stream')
+		return token
+
+	def _materialize(self):
+		rest = self.take_all()
+		self._ahead.extend(reversed(rest))
+		return rest
+
+	def __len__(self):
+		return len(self._materialize())
+
+	def __getitem__(self, key):
+		return self._materialize()[key]
+
+
 ########################################
 # PARAMETER METHODS
 ########################################
@@ -162,6 +1001,7 @@ def prompt(text, default=None, show_default=True, invisible=False,
 def _memoize_param(f, param):
 	if isinstance(f, Command):
 		f._params.add(param)
+		f._invalidate()  # Its suggestions must take in the new parameter
 	else:
 		if not hasattr(f, '__clip_params__'):
 			f.__clip_params__ = []
@@ -197,20 +1037,53 @@ class Parameter(object):
 
 	def __init__(self, param_decls, name=None, nargs=1, default=None,
 	             type=None, required=False, callback=None, hidden=False,
-	             inherit_only=False, help=None):
+	             inherit_only=False, help=None, lazy=False, cache_ttl=None,
+	             envvar=None, config_key=None, fanout=None, workers=None,
+	             ordered=True, choices=None, min=None, max=None, path_exists=False,
+	             stat_cache=None):
 		self._decls = param_decls
 		self._name = name or self._make_name(param_decls)
 		self._nargs = nargs
 		self._default = self._make_default(default, nargs)
+		if (lazy or cache_ttl is not None) and not is_func(self._default):
+			raise TypeError('lazy and cache_ttl require a function default')
+		self._lazy = lazy
+		self._cache_ttl = cache_ttl
+		self._cached = None  # (value, expiry) of the last cached default
+		self._envvar = envvar
+		self._config_key = config_key
 		self._type = determine_type(type, self._default)
+		if self._type is None and (min is not None or max is not None):
+			# The value is compared with the bounds, so convert it like them
+			self._type = determine_type(None, min if min is not None else max)
+		self._allowed = choices  # Only kept for help, checked by the converter
+		self._converter_spec = (self._type, choices, min, max, path_exists, stat_cache)
+		self._converter = compile_converter(*self._converter_spec)
 		self._required = required
 		self._callback = callback
 		self._hidden = hidden
 		self._inherit_only = inherit_only
 		self._help = help
+		if fanout not in (None, 'thread', 'process'):
+			raise TypeError('fanout must be "thread" or "process"')
+		if fanout is not None and nargs != -1:
+			raise TypeError('fanout requires nargs=-1')
+		self._fanout = fanout
+		self._workers = workers
+		self._ordered = ordered
 
 		self.reset()  # Do an initial reset to prime the parameter
 
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['_converter'] = None  # Compiled again on load
+		state['_cached'] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._converter = compile_converter(*self._converter_spec)
+
 	def reset(self):
 		self._value = None  # The parsed value of this parameter
 		self._satisfied = False  # True when this parameter has consumed tokens
@@ -240,6 +1113,8 @@ class Parameter(object):
 		desc = []
 		if self._help is not None:
 			desc.append(self._help)
+		if self._allowed is not None:
+			desc.append('(choices: {})'.format(', '.join(to_str(e) for e in self._allowed)))
 		if self._default:
 			desc.append('(default: {})'.format(self._default))
 		return [' '.join(name), ' '.join(desc)]
@@ -263,20 +1138,59 @@ class Parameter(object):
 		'''Have this parameter consume some tokens.
 
 		This stores the consumed value for later use and returns the
-		modified tokens array for further processing.
+		TokenStream, advanced past the consumed tokens, for further processing.
 		'''
-		n = len(tokens) if self._nargs == -1 else self._nargs
-		if n > len(tokens):
-			exit('Error: Not enough arguments for "{}".'.format(self._name), True)
+		if self._nargs == -1:
+			consumed = tokens.take_all()
+		else:
+			consumed = tokens.take(self._nargs)
+			if consumed is None:
+				exit('Error: Not enough arguments for "{}".'.format(self._name), True)
+		consumed = self._convert(consumed)
+		if self._nargs == 1:
+			consumed = consumed[0]
+		self.post_consume(consumed)
+		return tokens
+
+	def _convert(self, values):
+		if self._converter is None:
+			return list(values)
 		try:
-			consumed = [self._type(e) if self._type is not None else e for e in tokens[:n]]
+			return list(map(self._converter, values))
+		except _InvalidValue as e:
+			exit('Error: Invalid value given to "{}", {}.'.format(self._name, e), True)
 		except ValueError as e:
 			exit('Error: Invalid type given to "{}", expected {}.'.format(
 					self._name, self._type.__name__), True)
-		if n == 1 and self._nargs == 1:
-			consumed = consumed[0]
-		self.post_consume(consumed)
-		return tokens[n:]
+
+	def _external_default(self, app):
+		'''Looks up this parameter in the environment, then in the app config.
+
+		Returns a list of values like the one built by consume(), or None if
+		neither source provides this parameter.
+		'''
+		raw = None
+		if self._envvar is not None:
+			raw = os.environ.get(self._envvar)
+		if raw is None and self._config_key is not None and app is not None:
+			raw = app.config().get(self._config_key)
+		if raw is None:
+			return None
+		if self._nargs == 0:
+			if isinstance(raw, bool):
+				return [raw]
+			value = to_str(raw).lower()
+			if value in ('1', 'true', 'yes', 'on'):
+				return [True]
+			if value in ('', '0', 'false', 'no', 'off'):
+				return [False]
+			exit('Error: Invalid value given to "{}", expected true or false.'.format(self._name), True)
+		if not isinstance(raw, list):
+			raw = raw.split() if self._nargs != 1 and isinstance(raw, text_type) else [raw]
+		if self._nargs > 1 and len(raw) != self._nargs:
+			exit('Error: {} arguments for "{}".'.format(
+				'Not enough' if len(raw) < self._nargs else 'Too many', self._name), True)
+		return self._convert(raw)
 
 	def post_consume(self, consumed):
 		self._value = consumed
@@ -285,17 +1199,56 @@ class Parameter(object):
 		if self._callback is not None:
 			self._callback(self._value)
 
-	def set_default(self):
+	def set_default(self, app=None):
 		# If we're calling this method, then this parameter wasn't provided
+		external = self._external_default(app)
+		if external is not None:
+			self._value = external[0] if self._nargs in (0, 1) else external
+			return
 		if self._required:
 			exit('Error: Missing parameter "{}".'.format(self._name), True)
 		# The provided default can be a function, whose return value will be used
-		self._value = self._default() if is_func(self._default) else self._default
+		if not is_func(self._default):
+			self._value = self._default
+		elif self._lazy:
+			self._value = Lazy(self._call_default)
+		else:
+			self._value = self._call_default()
+
+	def _call_default(self):
+		if self._cache_ttl is None:
+			return self._default()
+		now = time.time()
+		if self._cached is None or now >= self._cached[1]:
+			self._cached = (self._default(), now + self._cache_ttl)
+		return self._cached[0]
 
 	def matches(self, token):
 		return not self._satisfied
 
 
+class Lazy(object):
+	'''A deferred default value, passed in place of the value itself.
+
+	Calling it evaluates the default on first access and returns the same
+	memoized value on every later call.
+	'''
+
+	def __init__(self, f):
+		self._f = f
+		self._evaluated = False
+		self._value = None
+
+	def __call__(self):
+		if not self._evaluated:
+			self._value = self._f()
+			self._evaluated = True
+		return self._value
+
+	def evaluated(self):
+		return self._evaluated
+
+
 class Argument(Parameter):
 	'''A positional parameter.
 	'''
@@ -366,6 +1319,15 @@ class ParameterDict(object):
 			m[decl] = i
 		m[param.name()] = i
 
+	def value_option(self, decl):
+		'''Returns the option with the given declaration if it would take a value.
+		'''
+		if decl in self._opts_map:
+			possible = self._opts[self._opts_map[decl]]
+			if possible._nargs != 0 and possible.matches(decl):
+				return possible
+		return None
+
 	def match(self, token):
 		match = None
 		if token in self._opts_map:
@@ -412,6 +1374,110 @@ def command(name=None, **attrs):
 		return _make_command(f, name, attrs)
 	return decorator
 
+class _CallbackRef(object):
+	'''A reference to a command callback by module and name, which (unlike
+	the callback, shadowed by its Command) can be pickled. The callback is
+	looked up the first time it is called.
+
+	A callback that its name doesn't lead back to, like a nested function,
+	a bound method or one of two functions of the same name, is refused
+	with a TypeError rather than resolving to the wrong function.
+	'''
+
+	def __init__(self, f):
+		self._f = None
+		if isinstance(f, _CallbackRef):
+			self._module, self._name = f._module, f._name
+			return
+		self._module = f.__module__
+		self._name = getattr(f, '__qualname__', f.__name__)
+		if '<' in self._name:
+			raise TypeError('Callback "{}" cannot be referenced by name'.format(self._name))
+		try:
+			found = self.resolve()
+		except (ImportError, AttributeError):
+			found = None
+		self._f = None
+		if found is not f:
+			raise TypeError('Callback "{}" cannot be referenced by name, as "{}.{}" is something else'.format(
+				f.__name__, self._module, self._name))
+
+	def __getstate__(self):
+		return {'_module': self._module, '_name': self._name, '_f': None}
+
+	def resolve(self):
+		if self._f is None:
+			__import__(self._module)
+			f = sys.modules[self._module]
+			for part in self._name.split('.'):
+				f = getattr(f, part)
+			self._f = f._callback if isinstance(f, Command) else f
+		return self._f
+
+	def __call__(self, *args, **kwargs):
+		return self.resolve()(*args, **kwargs)
+
+class _CommandMethod(object):
+	'''A method of a command, used as a parameter callback. Unlike a bound
+	method, it can be pickled on Python 2 as well.
+	'''
+
+	def __init__(self, command, name):
+		self._command = command
+		self._name = name
+
+	def __call__(self, *args, **kwargs):
+		return getattr(self._command, self._name)(*args, **kwargs)
+
+def _call_with_kwargs(f, kwargs):
+	return f(**kwargs)
+
+HELP_CHUNK_LINES = 1000  # Help longer than this is streamed, not built in one piece
+
+def _terminal_rows():
+	try:
+		import shutil
+		return shutil.get_terminal_size().lines
+	except (ImportError, AttributeError):
+		return 24
+
+def _page(lines):
+	'''Pipes lines through the user's pager, returning False if there is none.
+	'''
+	import subprocess
+	pager = os.environ.get('PAGER')
+	if not pager:
+		try:
+			from shutil import which
+		except ImportError:
+			return False
+		if which('less') is None:
+			return False
+		pager = 'less'
+	try:
+		proc = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE)
+	except OSError:
+		return False
+	try:
+		for line in lines:
+			proc.stdin.write(u'{}\n'.format(line).encode('utf-8'))
+		proc.stdin.close()
+	except (IOError, OSError):
+		pass  # The user quit the pager before reaching the end
+	proc.wait()
+	return True
+
+def _capture_call(f, args, token=None, scope=(None, None)):
+	# Pool threads can still be cancelled, and take on the caller's echo
+	# scope and scripted answers (as the worker of _call_with_timeout does)
+	local = clip_globals._local
+	local.token = token
+	local.app, local.answers = scope
+	try:
+		return clip_globals._capture(f, args)
+	finally:
+		local.token = local.app = local.answers = None
+
 
 ########################################
 # COMMAND CLASS
@@ -420,17 +1486,19 @@ def command(name=None, **attrs):
 class Command(object):
 
 	def __init__(self, name, callback, params, parent=None, default=None,
-	             description=None, epilogue=None, inherits=None, tree_view=None):
+	             description=None, epilogue=None, inherits=None, tree_view=None,
+	             timeout=None):
 		self._name = name
 		self._callback = callback
 		self._parent = parent
 		self._default = default
 		self._description = description
 		self._epilogue = epilogue
+		self._timeout = timeout
 
 		self._inherited = []
 		# Add help to every command and shim in inherited parameters
-		params.insert(0, Flag(('-h', '--help'), callback=self.help, hidden=True,
+		params.insert(0, Flag(('-h', '--help'), callback=_CommandMethod(self, 'help'), hidden=True,
 		                      help='Show this help message and exit'))
 		if inherits is not None:
 			if self._parent is None:
@@ -440,23 +1508,54 @@ class Command(object):
 				params.append(param)
 				self._inherited.append(param.name())
 		self._params = ParameterDict(params)
+		# Handle fan-out, where the callback is invoked once per value
+		fanout = [e for e in params if e._fanout is not None]
+		if len(fanout) > 1:
+			raise AttributeError('A command can only fan out over one parameter')
+		self._fanout = fanout[0] if fanout else None
 		# Handle tree view
 		if tree_view is not None:
 			c = self._params[tree_view]
 			if not isinstance(c, Flag):
 				raise TypeError('tree_view must be a Flag')
-			c._callback = self.tree_view
+			c._callback = _CommandMethod(self, 'tree_view')
 
 		self._subcommands = {}
+		self._sorted_subcommands = None  # Cached by _get_sorted_subcommands()
+		self._tree_cache = None  # Cached by render_tree()
+		self._suggestions = None  # Index built by _suggest() on the first error
+		self._app = None  # Set on the main command by the owning App
+		self._middleware = []  # Added by use()
+		self._app_middleware = None  # The owning app's middleware list, shared
+		self._chain = None  # Middleware composed around the callback, if any
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		# The callback's name is shadowed by this command, so refer to it by
+		# name instead, and drop whatever is rebuilt on load
+		try:
+			state['_callback'] = _CallbackRef(self._callback)
+		except TypeError:
+			pass  # A nested function, which can still be copied but not pickled
+		for k in ('_sorted_subcommands', '_tree_cache', '_suggestions', '_chain'):
+			state[k] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._compose()
 
 	def reset(self):
-		# Reset all parameters associated with this command
-		for param in self._params.all():
-			param.reset()
+		self._reset_params()
 		# Recurse into subcommands
 		for v in self._subcommands.values():
 			v.reset()
 
+	def _reset_params(self):
+		# Reset all parameters associated with this command
+		for param in self._params.all():
+			param.reset()
+
 	def __call__(self, *args, **kwargs):
 		return self._callback(*args, **kwargs)
 
@@ -467,6 +1566,58 @@ class Command(object):
 		path = self._parent._get_path() if self._parent is not None else []
 		return path + [self._name]
 
+	def _get_sorted_subcommands(self):
+		if self._sorted_subcommands is None:
+			self._sorted_subcommands = sorted(self._subcommands.values(), key=lambda e: e.name())
+		return self._sorted_subcommands
+
+	def _invalidate(self):
+		# The tree below this command changed, so drop any cached views of it
+		cmd = self
+		while cmd is not None:
+			cmd._tree_cache = None
+			cmd = cmd._parent
+		self._sorted_subcommands = None
+		self._suggestions = None
+
+	def _suggest(self, token):
+		'''Returns the subcommand name or option closest to token, if any is
+		close enough to be what the user meant.
+		'''
+		if len(token) < 3:
+			return None  # Too short to tell apart from other short tokens
+		if self._suggestions is None:
+			words = list(self._subcommands)
+			for param in self._params.options():
+				words.extend(e for e in param._decls if len(e) > 2)
+			self._suggestions = _NgramIndex(words)
+		return self._suggestions.closest(token, max(1, len(token) // 3))
+
+	def _get_app(self):
+		return self._parent._get_app() if self._parent is not None else self._app
+
+	def _call_callback(self, parsed):
+		return self._callback(**{k: v for k, v in iteritems(parsed) if k not in self._subcommands})
+
+	def _compose(self):
+		# Wrap the callback in the app's middleware, then this command's own,
+		# so invoke() pays nothing extra when no middleware is installed. A
+		# fan-out is wrapped as a whole, so middleware runs once, in this process
+		middleware = (self._app_middleware or []) + self._middleware
+		chain = None
+		if middleware:
+			chain = self._call_callback if self._fanout is None else self._invoke_fanout
+			for mw in reversed(middleware):
+				chain = functools.partial(mw, chain, self)
+		self._chain = chain
+
+	def _walk(self):
+		stack = [self]
+		while stack:
+			cmd = stack.pop()
+			yield cmd
+			stack.extend(cmd._subcommands.values())
+
 	def _get_inherited_param(self, name):
 		if name in self._params:
 			return self._params[name]
@@ -482,30 +1633,77 @@ class Command(object):
 			attrs['parent'] = self
 			cmd = command(name, **attrs)(f)
 			self._subcommands[cmd._name] = cmd
+			self._invalidate()
+			cmd._app_middleware = self._app_middleware
+			cmd._compose()
 			return cmd
 		return decorator
 
+	def use(self, middleware):
+		'''Wraps this command's callback in a middleware.
+
+		A middleware is called as middleware(call_next, command, parsed), where
+		parsed is what parse() returned for the command, and must call
+		call_next(parsed) to go on to the next middleware and finally the
+		callback. Middleware added later runs closer to the callback.
+		'''
+		self._middleware.append(middleware)
+		self._compose()
+		return middleware
+
 	def parse(self, tokens):
 		parsed = {}
+		if not isinstance(tokens, TokenStream):
+			tokens = TokenStream(tokens)
+
+		# Record that this command's state needs resetting after the run
+		app = self._get_app()
+		if app is not None:
+			app._touched.append(self)
 
 		if not tokens and self._default is not None:
-			tokens = self._default.split()
+			tokens = TokenStream(self._default.split())
 
 		# Pass 1: Forward - fill out parameter values based on input string
-		while tokens:
-			token = tokens[0]
+		while True:
+			token = tokens.peek()
+			if token is _END:
+				break
+			if tokens.globbed():
+				# -ovalue gives an option its value, otherwise -abc --> -a -b -c
+				if self._params.value_option(token[:2]) is not None:
+					tokens.split(token[:2], token[2:])
+				else:
+					tokens.expand()
+				continue
 			if token in self._subcommands:
-				tokens.pop(0)
+				tokens.next()
 				parsed[token] = self._subcommands[token].parse(tokens)
 				break  # The subcommand handles the remaining tokens
+			if token.startswith('--') and '=' in token and token not in self._params:
+				# --opt=value gives an option its value
+				decl, value = token.split('=', 1)
+				if self._params.value_option(decl) is not None:
+					tokens.split(decl, value)
+					continue
 			match = self._params.match(token)
 			if not match:
-				exit('Error: Could not understand "{}".'.format(token), True)
+				suggestion = self._suggest(token)
+				exit('Error: Could not understand "{}".{}'.format(token,
+						'' if suggestion is None else ' Did you mean "{}"?'.format(suggestion)), True)
 			tokens = match.consume(tokens)
+			if not isinstance(tokens, TokenStream):
+				tokens = TokenStream(tokens)  # An extension returned a list
 
 		# Pass 2: Backward - fill out missing parameters
-		for param in self._params.unsatisfied():
-			param.set_default()
+		unsatisfied = self._params.unsatisfied()
+		if unsatisfied:
+			start = timer()
+			for param in unsatisfied:
+				param.set_default(app)
+			if app is not None:
+				app._stats['defaults'] += len(unsatisfied)
+				app._stats['defaults_time'] += timer() - start
 
 		# Pass 3: Build the JSON-serializable object to return
 		for param in self._params.all():
@@ -515,59 +1713,154 @@ class Command(object):
 		return parsed
 
 	def invoke(self, parsed):
-		# First invoke this command's callback
-		self._callback(**{k: v for k, v in iteritems(parsed) if k not in self._subcommands})
+		# First invoke this command's callback, giving up after any timeout
+		if self._timeout is None:
+			self._invoke_callback(parsed)
+		else:
+			app = self._get_app()
+			_call_with_timeout(self._invoke_callback, parsed, self._timeout,
+			                   'Command "{}"'.format(self._name), app._name if app is not None else None)
 		# Invoke subcommands (realistically only one should be invoked)
 		for k, v in iteritems(parsed):
 			if k in self._subcommands:
 				self._subcommands[k].invoke(v)
 
-	def help(self, value):
-		help_parts = []
-		usage = []
+	def _invoke_callback(self, parsed):
+		# Invoke this command's callback, through any middleware
+		if self._chain is not None:
+			self._chain(parsed)
+		elif self._fanout is not None:
+			self._invoke_fanout(parsed)
+		else:
+			self._callback(**{k: v for k, v in iteritems(parsed) if k not in self._subcommands})
 
-		# Header
+	def _invoke_fanout(self, parsed):
+		'''Invokes the callback once per value of the fan-out parameter, on a
+		pool of threads or processes.
+
+		What each call echoes is held back and written out in one piece, in
+		the order of the values or (if not ordered) as the calls complete.
+		Failed calls are reported, and make the command exit with status 1.
+		'''
+		import concurrent.futures
+		param = self._fanout
+		name = param.name()
+		kwargs = {k: v for k, v in iteritems(parsed) if k not in self._subcommands}
+		values = kwargs[name] or []
+		if param._fanout == 'process':
+			# Processes cannot share the command, so they look up its callback
+			pool = concurrent.futures.ProcessPoolExecutor(param._workers)
+			call, token = functools.partial(_call_with_kwargs, _CallbackRef(self._callback)), None
+			scope = (None, None)
+		else:
+			pool = concurrent.futures.ThreadPoolExecutor(param._workers)
+			call = self._call_callback
+			local = clip_globals._local
+			token = getattr(local, 'token', None)
+			scope = (getattr(local, 'app', None), getattr(local, 'answers', None))
+		app = self._get_app()
+		app = app._name if app is not None else None
+		failed = 0
+		with pool:
+			futures = []
+			for value in values:
+				args = dict(kwargs)
+				args[name] = value
+				futures.append(pool.submit(_capture_call, call, args, token, scope))
+			index = {e: i for i, e in enumerate(futures)}
+			done = futures if param._ordered else concurrent.futures.as_completed(futures)
+			for future in done:
+				output, status, error = future.result()
+				for message, err, nl, target in output:
+					echo(message, err, nl, target or app)
+				if error is not None:
+					echo('Error: "{}" failed with {}'.format(values[index[future]], error), True, app=app)
+				if status != 0:
+					failed += 1
+		if failed:
+			exit('Error: {} of {} calls to "{}" failed.'.format(failed, len(values), self._name), True, app)
+
+	def _help_lines(self):
+		'''Generates the lines of this command's help, a section at a time.
+
+		Each column of a section is as wide as its widest entry. Large sections
+		are gone over twice (once for the width) rather than held in memory.
+		'''
 		header = ' '.join(self._get_path())
 		if self._description is not None:
 			header = '{}: {}'.format(header, self._description)
-		help_parts.append(header)
-
-		# Main help sections (title, followed by 2-column list)
-		def make_help_section(l, title):
-			data = [e._get_help() for e in l]
-			width = max(len(e[0]) for e in data) + 2
-			return '\n'.join([title] + [('  {}{}'.format(e[0].ljust(width), e[1])).rstrip () for e in data])
-
-		args = self._params.arguments()
-		if args:
-			usage.append('{{arguments}}')
-			help_parts.append(make_help_section(args, 'Arguments:'))
-		opts = self._params.options()
-		if opts:
-			usage.append('{{options}}')
-			help_parts.append(make_help_section(opts, 'Options:'))
-		subs = sorted(self._subcommands.values(), key=lambda e: e.name())
-		if subs:
-			usage.append('{{subcommand}}')
-			help_parts.append(make_help_section(subs, 'Subcommands:'))
-
-		# Now we know the usage string, so insert it
-		help_parts.insert(1, 'Usage: {} {}'.format(self._name, ' '.join(usage)))
-
-		# Epilogue
+		sections = [
+			(self._params.arguments(), 'Arguments:', '{{arguments}}'),
+			(self._params.options(), 'Options:', '{{options}}'),
+			(self._get_sorted_subcommands(), 'Subcommands:', '{{subcommand}}')
+		]
+		sections = [e for e in sections if e[0]]
+		yield header
+		yield ''
+		yield 'Usage: {} {}'.format(self._name, ' '.join(e[2] for e in sections))
+		for l, title, _ in sections:
+			# Main help sections (title, followed by 2-column list)
+			if len(l) <= HELP_CHUNK_LINES:
+				data = [e._get_help() for e in l]
+				width = max(len(e[0]) for e in data) + 2
+			else:
+				data = (e._get_help() for e in l)
+				width = max(len(e._get_help()[0]) for e in l) + 2
+			yield ''
+			yield title
+			for name, desc in data:
+				yield '  {}{}'.format(name.ljust(width), desc).rstrip()
 		if self._epilogue is not None:
-			help_parts.append(self._epilogue)
+			yield ''
+			yield self._epilogue
 
-		exit('\n\n'.join(help_parts))
+	def help(self, value):
+		lines = self._help_lines()
+		first = list(itertools.islice(lines, HELP_CHUNK_LINES))
+		app = self._get_app()
+		if app is not None:
+			_count_request(app._metrics['help'], self)
+		if app is not None and app._pager and len(first) > _terminal_rows():
+			out = clip_globals._get_streams(False, app._name)[0]
+			if hasattr(out, 'isatty') and out.isatty() and _page(itertools.chain(first, lines)):
+				exit()
+		if len(first) < HELP_CHUNK_LINES:
+			exit('\n'.join(first))
+		# Too long to build in one piece, so write it out as it is generated
+		echo_lines(itertools.chain(first, lines))
+		exit()
 
 	def tree_view(self, value):
-		echo('{}{}'.format(" " * (value - 1), self._name))
-		subs = sorted(self._subcommands.values(), key=lambda e: e.name())
-		if subs:
-			for sub in subs:
-				sub.tree_view(value + 2)
-		if value == 1:
-			exit()
+		app = self._get_app()
+		if app is not None:
+			_count_request(app._metrics['tree_view'], self)
+		echo(self.render_tree())
+		exit()
+
+	def render_tree(self, max_depth=None, include=None):
+		'''Renders this command and its subcommands as an indented tree.
+
+		Subcommands deeper than max_depth are left out, as are subcommands for
+		which include(command) is false (along with their own subcommands).
+		The full tree is cached until a subcommand is added below this command.
+		'''
+		full = max_depth is None and include is None
+		if full and self._tree_cache is not None:
+			return self._tree_cache
+		lines = []
+		stack = [(self, 0)]
+		while stack:
+			cmd, depth = stack.pop()
+			lines.append('  ' * depth + cmd._name)
+			if cmd._subcommands and (max_depth is None or depth < max_depth):
+				subs = cmd._get_sorted_subcommands()
+				if include is not None:
+					subs = [e for e in subs if include(e)]
+				stack.extend((e, depth + 1) for e in reversed(subs))
+		tree = '\n'.join(lines)
+		if full:
+			self._tree_cache = tree
+		return tree
 
 
 ########################################
@@ -576,11 +1869,60 @@ class Command(object):
 
 class App(object):
 
-	def __init__(self, stdout=None, stderr=None, name=None):
+	def __init__(self, stdout=None, stderr=None, name=None, response_files=False,
+	             config=None, timeout=None, pager=False, record=None):
 		self._main = None
+		self._record = record  # Path of the JSONL log every run is appended to
+		self._pager = pager
+		self._timeout = timeout
+		self._middleware = []  # Wraps the callback of every command, see use()
 		self._name = name or str(uuid.uuid4())
+		self._response_files = response_files
+		self._config_path = config
+		self._config_cache = None  # (mtime, size, parsed config)
+		self._touched = []  # Commands parsed since the last reset
+		self._stats = {
+			'defaults': 0,  # Number of parameters filled in by pass 2
+			'defaults_time': 0.0,  # Seconds spent filling them in
+			'config_loads': 0  # Number of times the config file was parsed
+		}
+		self._metrics = {
+			'invocations': {},  # Command path --> number of times invoked
+			'exits': {},  # Exit status --> number of runs that ended with it
+			'exceptions': 0,  # Number of runs that raised something else
+			'parse_errors': {},  # Reason --> number of runs that failed to parse
+			'help': {},  # Command path --> number of times help was shown
+			'tree_view': {}  # Command path --> number of times the tree was shown
+		}
+		self._add_streams(stdout, stderr)
+		clip_globals._apps[self._name] = self
+
+	def _add_streams(self, stdout, stderr):
+		if self._record is not None:
+			# Count what is written, so each recorded run knows its output size
+			stdout = _CountingStream(stdout or sys.stdout)
+			stderr = _CountingStream(stderr or sys.stderr)
 		clip_globals.add_streams(stdout, stderr, self._name)
 
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['_config_cache'] = None
+		state['_touched'] = []
+		# Streams are held by clip_globals, so take them along (the standard
+		# streams are left out, and default to the loading process' own)
+		streams = [clip_globals._streams.get(self._name, {}).get(k) for k in ('out', 'err')]
+		streams = [e._stream if isinstance(e, _CountingStream) else e for e in streams]
+		standard = (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__)
+		state['_streams'] = tuple(None if e in standard else e for e in streams)
+		return state
+
+	def __setstate__(self, state):
+		out, err = state.pop('_streams')
+		self.__dict__.update(state)
+		if self._name not in clip_globals._streams:
+			self._add_streams(out, err)
+		clip_globals._apps.setdefault(self._name, self)
+
 	def _ping_main(self):
 		if self._main is None:
 			raise AttributeError('A main function must be assigned to this app')
@@ -590,13 +1932,172 @@ class App(object):
 			if self._main is not None:
 				raise AttributeError('A main function has already been assigned to this app')
 			cmd = command(name, **attrs)(f)
+			cmd._app = self
 			self._main = cmd
+			cmd._app_middleware = self._middleware
+			cmd._compose()
 			return cmd
 		return decorator
 
+	def use(self, middleware):
+		'''Wraps the callback of every command in this app in a middleware.
+
+		See Command.use(). App middleware runs before any command's own.
+		'''
+		self._middleware.append(middleware)
+		if self._main is not None:
+			for cmd in self._main._walk():
+				cmd._compose()
+		return middleware
+
 	def echo(self, message, err=False, nl=True):
 		echo(message, err, nl, app=self._name)
 
+	def echo_lines(self, lines, err=False, chunk_size=1024):
+		echo_lines(lines, err, app=self._name, chunk_size=chunk_size)
+
+	def config(self):
+		'''Returns this app's config file as a flat dict keyed by dotted path.
+
+		The parsed file is cached, and only parsed again once its modification
+		time or size changes. A missing config file is treated as empty.
+		'''
+		if self._config_path is None:
+			return {}
+		try:
+			st = os.stat(self._config_path)
+		except OSError:
+			return {}
+		cache = self._config_cache
+		if cache is None or cache[0] != st.st_mtime or cache[1] != st.st_size:
+			cache = self._config_cache = (st.st_mtime, st.st_size, load_config(self._config_path))
+			self._stats['config_loads'] += 1
+		return cache[2]
+
+	def run_async(self, tokens=None, loop=None, executor=None):
+		'''Runs the app in an executor of an asyncio event loop (by default
+		the running one), returning a future to await.
+
+		The app keeps state while it runs, so only one run may be in flight
+		at a time; use one app per concurrent run.
+		'''
+		if loop is None:
+			import asyncio
+			# get_event_loop() is deprecated outside a running loop since 3.12
+			loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+		return loop.run_in_executor(executor, self.run, tokens)
+
+	def stats(self):
+		'''Returns a snapshot of this app's instrumentation counters.
+		'''
+		return dict(self._stats)
+
+	def metrics(self):
+		'''Returns a snapshot of this app's usage counters: invocations and
+		help and tree view requests by command path, runs by exit status,
+		runs that raised an exception, and parse errors by reason.
+		'''
+		return {k: dict(v) if isinstance(v, dict) else v for k, v in iteritems(self._metrics)}
+
+	def prometheus(self, prefix='clip'):
+		'''Returns this app's metrics and stats in the Prometheus text format,
+		labelled with the app's name.
+		'''
+		app = _prometheus_label(self._name)
+		metrics = self.metrics()
+		families = [
+			('invocations', 'Commands invoked, by path.', 'command', metrics['invocations']),
+			('exits', 'Runs ended, by exit status.', 'status', metrics['exits']),
+			('exceptions', 'Runs that raised an exception.', None, metrics['exceptions']),
+			('parse_errors', 'Runs that failed to parse, by reason.', 'reason', metrics['parse_errors']),
+			('help_requests', 'Help screens shown, by command path.', 'command', metrics['help']),
+			('tree_view_requests', 'Command trees shown, by command path.', 'command', metrics['tree_view']),
+			('defaults', 'Parameters filled in with their defaults.', None, self._stats['defaults']),
+			('defaults_seconds', 'Seconds spent filling in defaults.', None, self._stats['defaults_time']),
+			('config_loads', 'Times the config file was parsed.', None, self._stats['config_loads'])
+		]
+		lines = []
+		for name, description, label, values in families:
+			name = '{}_{}_total'.format(prefix, name)
+			lines.append('# HELP {} {}'.format(name, description))
+			lines.append('# TYPE {} counter'.format(name))
+			if label is None:
+				lines.append('{}{{app="{}"}} {}'.format(name, app, values))
+				continue
+			for k, v in sorted(iteritems(values), key=lambda e: to_str(e[0])):
+				lines.append('{}{{app="{}",{}="{}"}} {}'.format(name, app, label, _prometheus_label(k), v))
+		return '\n'.join(lines) + '\n'
+
+	def memory_report(self, verify=False):
+		'''Reports the memory held by this app's command tree, in bytes.
+
+		Each command (keyed by its path) is broken down into its parameters,
+		help strings, subcommand map, default values and the command itself,
+		with its total and the total of its whole subtree. Objects shared by
+		several commands, like inherited parameters, are counted once. The
+		stream registry is reported separately, including the entries left
+		over from apps that no longer exist.
+
+		With verify, the tree is also deep-copied under tracemalloc, and the
+		memory the copy allocated is reported as 'traced'.
+		'''
+		self._ping_main()
+		seen = set()
+		commands = {}
+		stack = [(self._main, (self._main._name,))]
+		order = []
+		while stack:
+			cmd, path = stack.pop()
+			order.append((cmd, path))
+			params = cmd._params.all()
+			row = {
+				'help': sum(_deep_sizeof(e, seen) for e in [cmd._description, cmd._epilogue] + [p._help for p in params]),
+				'defaults': sum(_deep_sizeof(p._default, seen) + _deep_sizeof(p._cached, seen) for p in params),
+				'parameters': _deep_sizeof(cmd._params, seen),
+				'subcommands': sum(_deep_sizeof(e, seen) for e in (cmd._subcommands, cmd._sorted_subcommands)),
+				'command': sys.getsizeof(cmd) + _deep_sizeof(cmd.__dict__, seen)
+			}
+			row['total'] = row['subtree'] = sum(row.values())
+			commands[' '.join(path)] = row
+			stack.extend((e, path + (e._name,)) for e in cmd._subcommands.values())
+		for cmd, path in reversed(order):
+			if len(path) > 1:
+				commands[' '.join(path[:-1])]['subtree'] += commands[' '.join(path)]['subtree']
+		entries = {}
+		for name, streams in list(clip_globals._streams.items()):
+			entries[name] = _deep_sizeof(streams, set())
+		report = {
+			'commands': commands,
+			'total': commands[self._main._name]['subtree'],
+			'streams': {
+				'bytes': sys.getsizeof(clip_globals._streams) + sum(entries.values()),
+				'entries': entries,
+				'stale': sorted(e for e in entries if e not in clip_globals._apps)
+			}
+		}
+		if verify:
+			report['traced'] = self._traced_size()
+		return report
+
+	def _traced_size(self):
+		import copy
+		import tracemalloc
+		started = not tracemalloc.is_tracing()
+		if started:
+			tracemalloc.start()
+		try:
+			before = tracemalloc.take_snapshot()
+			# Share the app (and its streams) instead of copying it
+			memo = {id(self): self}
+			tree = copy.deepcopy(self._main, memo)
+			del memo  # Only the copy itself should be measured
+			after = tracemalloc.take_snapshot()
+		finally:
+			if started:
+				tracemalloc.stop()
+		del tree
+		return sum(e.size_diff for e in after.compare_to(before, 'filename'))
+
 	def exit(self, message=None, err=False):
 		exit(message, err, app=self._name)
 
@@ -618,20 +2119,47 @@ class App(object):
 		'''
 		self._ping_main()
 
-		# Pre-parsing:
-		#   1. Expand globbed options: -abc --> -a -b -c
-		def is_globbed(s):
-			return len(s) > 2 and s.startswith('-') and not s.startswith('--')
-		expanded = [["-" + c for c in list(token[1:])] if is_globbed(token) else [token] for token in tokens]
+		# Pre-parsing: expand response files (@path --> tokens in path)
+		if self._response_files:
+			tokens = self._expand_response_files(tokens)
 
-		# Parsing: pass off to main command after flattening expanded tokens list
-		return self._main.parse(list(itertools.chain.from_iterable(expanded)))
+		# Parsing: pass off to main command, which pulls tokens one at a time
+		# and splits globbed options (-abc, -ovalue, --opt=value) as it goes
+		try:
+			return self._main.parse(TokenStream(tokens))
+		except ClipExit as e:
+			if e.status != 0:
+				errors = self._metrics['parse_errors']
+				reason = _parse_error_reason(e.message)
+				errors[reason] = errors.get(reason, 0) + 1
+			raise
+
+	def _expand_response_files(self, tokens):
+		for token in tokens:
+			if len(token) > 1 and token.startswith('@'):
+				for e in read_response_file(token[1:]):
+					yield e
+			else:
+				yield token
 
 	def invoke(self, parsed):
 		'''Invokes the app, given a parsed token object.
 		'''
 		self._ping_main()
-		self._main.invoke(parsed)
+		# Count the invocation of each command along the parsed path
+		counts = self._metrics['invocations']
+		cmd, path, args = self._main, self._main._name, parsed
+		while cmd is not None:
+			counts[path] = counts.get(path, 0) + 1
+			sub = next((k for k in args if k in cmd._subcommands), None)
+			if sub is None:
+				break
+			cmd, path, args = cmd._subcommands[sub], path + ' ' + sub, args[sub]
+		if self._timeout is None:
+			self._main.invoke(parsed)
+		else:
+			_call_with_timeout(self._main.invoke, parsed, self._timeout,
+			                   'App "{}"'.format(self._main.name()), self._name)
 
 	def reset(self):
 		'''Returns the app to its initial state.
@@ -639,17 +2167,384 @@ class App(object):
 		This is necessary because parsing/invoking causes state to be stored
 		in the commands and parameters, meaning that the app cannot be run
 		again. After a reset, the app is freely available for reuse.
+
+		Only the commands that were parsed since the last reset hold any state,
+		so only they are reset. This costs O(path length) instead of O(tree).
 		'''
 		self._ping_main()
-		self._main.reset()
+		for cmd in self._touched:
+			cmd._reset_params()
+		self._touched = []
 
 	def run(self, tokens=None):
 		if tokens is None:
 			tokens = sys.argv[1:]
 		if isinstance(tokens, text_type):
-			tokens = shlex.split(tokens)
+			tokens = split(tokens)
+		recording = self._record is not None
+		if recording:
+			tokens = list(tokens)
+			written = self._output_bytes()
+			start = timer()
+		parsed, status = None, None  # None unless the run ended normally or exited
 		try:
-			self.invoke(self.parse(tokens))
+			parsed = self.parse(tokens)
+			self.invoke(parsed)
+			status = 0
+		except ClipExit as e:
+			status = e.status
+			raise
 		finally:
 			self.reset()  # Clean up so the app can be used again
+			if status is None:
+				self._metrics['exceptions'] += 1
+			else:
+				exits = self._metrics['exits']
+				exits[status] = exits.get(status, 0) + 1
+			if recording:
+				self._write_record(tokens, parsed, 1 if status is None else status,
+				                   timer() - start, self._output_bytes() - written)
 		return self
+
+	def _output_bytes(self):
+		streams = clip_globals._streams.get(self._name, {})
+		return sum(getattr(e, 'count', 0) for e in streams.values())
+
+	def _write_record(self, tokens, parsed, status, duration, output_bytes):
+		import json
+		record = {
+			'time': time.time(),
+			'tokens': tokens,
+			'parsed': parsed,
+			'duration': duration,
+			'status': status,
+			'output_bytes': output_bytes
+		}
+		with open(self._record, 'a') as f:
+			f.write(json.dumps(record, default=to_str, sort_keys=True) + '\n')
+
+########################################
+# ROUTER
+########################################
+
+class Router(object):
+	'''Dispatches tokens to one of many apps, chosen by the first token.
+
+	Apps are held in a dict keyed by name, so dispatching costs the same no
+	matter how many apps are registered. An app may also be registered as a
+	factory function, which is only called (once) the first time the app is
+	dispatched to. If a separator is given, the first token may also carry
+	the first token of the app itself, e.g. "tenant:command" with ':'.
+	'''
+
+	def __init__(self, separator=None, stderr=None):
+		self._apps = {}
+		self._factories = {}
+		self._separator = separator
+		self._stderr = stderr or sys.stderr
+		self._lock = threading.Lock()  # Guards lazy construction of apps
+
+	def add(self, name, app):
+		'''Registers an app, or a function returning one, under a name.
+		'''
+		if name in self._apps or name in self._factories:
+			raise AttributeError('An app named "{}" has already been added to this router'.format(name))
+		if isinstance(app, App):
+			self._apps[name] = app
+		elif is_func(app):
+			self._factories[name] = app
+		else:
+			raise TypeError('Router entries must be apps or functions returning an app')
+
+	def route(self, name):
+		'''Decorator form of add(), for registering app factories.
+		'''
+		def decorator(f):
+			self.add(name, f)
+			return f
+		return decorator
+
+	def get(self, name):
+		'''Returns the app registered under a name, building it if need be,
+		or None if there is no such app.
+		'''
+		app = self._apps.get(name)
+		if app is None and name in self._factories:
+			with self._lock:
+				app = self._apps.get(name)
+				if app is None:
+					app = self._factories[name]()
+					if not isinstance(app, App):
+						raise TypeError('The factory for "{}" did not return an app'.format(name))
+					self._apps[name] = app
+					del self._factories[name]
+		return app
+
+	def __contains__(self, name):
+		return name in self._apps or name in self._factories
+
+	def __len__(self):
+		return len(self._apps) + len(self._factories)
+
+	def names(self):
+		return sorted(itertools.chain(self._apps, self._factories))
+
+	def run(self, tokens=None):
+		'''Runs the app named by the first token on the remaining tokens.
+
+		While the app runs, echo() without an app writes only to its streams
+		instead of broadcasting to every app clip knows about.
+		'''
+		if tokens is None:
+			tokens = sys.argv[1:]
+		if isinstance(tokens, text_type):
+			tokens = split(tokens)
+		tokens = iter(tokens)
+		name = next(tokens, None)
+		if name is None:
+			self._fail('Error: No app given.')
+		if self._separator is not None and name not in self and self._separator in name:
+			name, first = name.split(self._separator, 1)
+			if first:
+				tokens = itertools.chain([first], tokens)
+		app = self.get(name)
+		if app is None:
+			self._fail('Error: No app named "{}".'.format(name))
+		with clip_globals._scope(app._name):
+			return app.run(tokens)
+
+	def _fail(self, message):
+		clip_globals._write(message, self._stderr)
+		raise ClipExit(message, 1)
+
+
+########################################
+# MIDDLEWARE
+########################################
+
+class LatencyHistogram(object):
+	'''Middleware that records how long each command's callback takes.
+
+	Durations are counted into buckets (upper bounds, in seconds) separately
+	for every command, keyed by the command's path, e.g. "app sub".
+	'''
+
+	DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self._buckets = sorted(buckets)
+		self._data = {}  # Path --> [counts per bucket + overflow, total seconds]
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_lock']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def __call__(self, call_next, command, parsed):
+		start = timer()
+		try:
+			return call_next(parsed)
+		finally:
+			self.record(' '.join(command._get_path()), timer() - start)
+
+	def record(self, path, seconds):
+		i = bisect.bisect_left(self._buckets, seconds)
+		with self._lock:
+			data = self._data.get(path)
+			if data is None:
+				data = self._data[path] = [[0] * (len(self._buckets) + 1), 0.0]
+			data[0][i] += 1
+			data[1] += seconds
+
+	def snapshot(self):
+		'''Returns a dict mapping each command path to its count, sum (total
+		seconds) and buckets, a list of (upper bound, cumulative count) pairs
+		ending with (float('inf'), count).
+		'''
+		with self._lock:
+			ret = {}
+			bounds = self._buckets + [float('inf')]
+			for path, (counts, total) in iteritems(self._data):
+				buckets, n = [], 0
+				for bound, count in zip(bounds, counts):
+					n += count
+					buckets.append((bound, n))
+				ret[path] = {'count': n, 'sum': total, 'buckets': buckets}
+			return ret
+
+
+class SlowCommandLogger(object):
+	'''Middleware that logs a warning whenever a command's callback takes
+	longer than threshold seconds.
+	'''
+
+	def __init__(self, threshold=1.0, logger=None):
+		import logging
+		self._threshold = threshold
+		self._logger = logger or logging.getLogger('clip')
+
+	def __call__(self, call_next, command, parsed):
+		start = timer()
+		try:
+			return call_next(parsed)
+		finally:
+			elapsed = timer() - start
+			if elapsed > self._threshold:
+				self._logger.warning('Command "%s" took %.3fs (%s)', ' '.join(command._get_path()), elapsed, parsed)
+
+
+########################################
+# TESTING
+########################################
+
+class RunResult(object):
+	'''What an app did when run by a Runner.
+	'''
+
+	def __init__(self, stdout, stderr, status, exception):
+		self.stdout = stdout
+		self.stderr = stderr
+		self.status = status  # Exit status, 0 unless the app exited with an error
+		self.exception = exception  # Exception other than ClipExit, if any
+
+	def __repr__(self):
+		return '<RunResult status={}>'.format(self.status)
+
+
+class Runner(object):
+	'''Runs apps in-process for testing, isolated from other runs.
+
+	Everything the app echoes is captured for this run alone and prompts are
+	answered from a script (see Answers), without touching any module state,
+	so runs on different threads do not interfere with each other. A prompt
+	with no scripted answer fails instead of waiting for input.
+	'''
+
+	def __init__(self, answers=None):
+		self._answers = answers
+
+	def invoke(self, app, tokens=None, answers=None):
+		'''Runs app on tokens (a list or a string) and returns a RunResult.
+		'''
+		if answers is None:
+			answers = self._answers
+		local = clip_globals._local
+		saved = tuple(getattr(local, e, None) for e in ('app', 'buffer', 'answers'))
+		buffer = local.buffer = []
+		local.app = None
+		local.answers = get_answers([] if answers is None else answers)
+		status, exception = 0, None
+		try:
+			app.run([] if tokens is None else tokens)
+		except ClipExit as e:
+			status = e.status
+		except Exception as e:
+			status, exception = 1, e
+		finally:
+			local.app, local.buffer, local.answers = saved
+		out, err = [], []
+		for message, is_err, nl, _ in buffer:
+			(err if is_err else out).append(message + ('\n' if nl else ''))
+		return RunResult(u''.join(out), u''.join(err), status, exception)
+
+
+########################################
+# REPLAY
+########################################
+
+def read_records(path):
+	'''Yields the records of a log written by App(record=path), in order.
+	'''
+	import json
+	with open(path) as f:
+		for line in f:
+			if line.strip():
+				yield json.loads(line)
+
+def _percentile(ordered, p):
+	# Nearest-rank percentile of an already sorted list
+	if not ordered:
+		return None
+	return ordered[max(0, min(len(ordered) - 1, int(-(-p * len(ordered) // 100)) - 1))]
+
+def replay(app, path, rate=None, concurrency=1, limit=None):
+	'''Runs an app on the tokens of every run recorded in path, and reports
+	how it held up.
+
+	Runs are started at rate runs per second (or as fast as possible if rate
+	is None) by concurrency threads, each with its own app: app may be an App,
+	which is then copied for each thread, or a function returning an App. At
+	most limit runs are replayed. Whatever the runs echo is discarded, and
+	the apps don't record the replayed runs while they are replayed.
+
+	Returns a dict with the number of runs, the number that exited with a
+	non-zero status, the number whose status differs from the recorded one,
+	the counts of each status, the wall time in seconds, the throughput in
+	runs per second and the latency (mean, p50, p90, p99 and max) in seconds.
+	'''
+	import copy
+	if isinstance(app, App):
+		apps = [app] + [copy.deepcopy(app) for _ in range(concurrency - 1)]
+	else:
+		apps = [app() for _ in range(concurrency)]
+	# Otherwise a recording app would keep adding to the log being replayed
+	recording = [e._record for e in apps]
+	for e in apps:
+		e._record = None
+	records = read_records(path)
+	if limit is not None:
+		records = itertools.islice(records, limit)
+	records = enumerate(records)
+	lock = threading.Lock()
+	results = []  # (latency, status, recorded status)
+	start = timer()
+
+	def work(app):
+		while True:
+			with lock:
+				try:
+					i, record = next(records)
+				except StopIteration:
+					return
+			if rate is not None:
+				delay = start + i / float(rate) - timer()
+				if delay > 0:
+					time.sleep(delay)
+			began = timer()
+			_, status, _ = clip_globals._capture(app.run, record['tokens'])
+			results.append((timer() - began, status, record.get('status')))
+
+	threads = [threading.Thread(target=work, args=(e,)) for e in apps]
+	try:
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+	finally:
+		for e, record in zip(apps, recording):
+			e._record = record
+	elapsed = timer() - start
+	latencies = sorted(e[0] for e in results)
+	statuses = {}
+	for _, status, _ in results:
+		statuses[status] = statuses.get(status, 0) + 1
+	return {
+		'runs': len(results),
+		'errors': sum(1 for e in results if e[1] != 0),
+		'mismatches': sum(1 for e in results if e[2] is not None and e[1] != e[2]),
+		'statuses': statuses,
+		'duration': elapsed,
+		'throughput': len(results) / elapsed if elapsed > 0 else 0.0,
+		'latency': {
+			'mean': sum(latencies) / len(latencies) if latencies else None,
+			'p50': _percentile(latencies, 50),
+			'p90': _percentile(latencies, 90),
+			'p99': _percentile(latencies, 99),
+			'max': latencies[-1] if latencies else None
+		}
+	}
@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
 import unittest
 import contextlib
+import gc
+import os
+import pickle
+import random
+import shlex
+import sys
+import tempfile
+import threading
+import time
 
 import clip
 
@@ -15,6 +24,14 @@ def mock_clip_input(s):
 	clip.input = cache
 
 
+def has_module(name):
+	try:
+		__import__(name)
+		return True
+	except ImportError:
+		return False
+
+
 class Stream(object):
 	def __init__(self):
 		self._writes = []
@@ -57,11 +74,18 @@ class BaseTest(unittest.TestCase):
 
 		return app
 
-	def embed(self):
+	def embed(self, **attrs):
 		out, err = Stream(), Stream()
-		app = clip.App(stdout=out, stderr=err)
+		app = clip.App(stdout=out, stderr=err, **attrs)
 		return app, out, err
 
+	def write_file(self, content='', suffix=''):
+		fd, path = tempfile.mkstemp(suffix=suffix)
+		with os.fdopen(fd, 'w') as f:
+			f.write(content)
+		self.addCleanup(os.remove, path)
+		return path
+
 	def make_embedded_app(self):
 		app, out, err = self.embed()
 
@@ -96,6 +120,34 @@ class TestGlobals(BaseTest):
 		clip.echo(u'你好')
 		self.assertEqual(out._writes, [u'你好\n'])
 
+	def test_echo_lines(self):
+		app, out, err = self.embed()
+		clip.echo_lines(range(5), chunk_size=2)
+		self.assertEqual(out._writes, ['0\n1\n', '2\n3\n', '4\n'])
+		app.echo_lines(iter([u'你', u'好']), err=True)
+		self.assertEqual(err._writes, [u'你\n好\n'])
+
+	def test_progress(self):
+		app, _, err = self.embed()
+		self.assertEqual(list(clip.progress(range(1000), label='Working', app=app._name)), list(range(1000)))
+		# Not a TTY, so only the first and last updates are printed
+		self.assertEqual(err._writes, ['Working: 1/1000 (0%)\n', 'Working: 1000/1000 (100%)\n'])
+		# Leaving the loop early still draws the final status
+		err._writes = []
+		for i in clip.progress(range(1000), app=app._name):
+			if i == 9:
+				break
+		self.assertEqual(err._writes, ['1/1000 (0%)\n', '10/1000 (1%)\n'])
+
+	def test_status(self):
+		_, _, err = self.embed()
+		err.isatty = lambda: True
+		status = clip.Status(interval=60)
+		for e in ['Loading', 'Still loading', 'Almost done']:
+			status.update(e)
+		status.done('Done')
+		self.assertEqual(err._writes, ['\rLoading', '\rDone   ', '\n'])
+
 	def test_exit(self):
 		self.embed()
 		# Standard case, custom message
@@ -147,6 +199,55 @@ class TestGlobals(BaseTest):
 			self.assertIsNone(clip.prompt('?', confirm=True, skip=True))
 
 
+class TestAnswers(BaseTest):
+
+	def tearDown(self):
+		clip.set_answers(None)
+
+	def test_mapping(self):
+		answers = {'Name': 'Joe', 'Age': ['7', 8], 'Sure?': True}
+		self.assertEqual(clip.prompt('Name', answers=answers), 'Joe')
+		clip.set_answers(answers)
+		self.assertEqual(clip.prompt('Name', confirm=True), 'Joe')
+		self.assertEqual([clip.prompt('Age', type=int) for _ in range(2)], [7, 8])
+		self.assertTrue(clip.confirm('Sure?', default='no'))
+
+	def test_input_function(self):
+		clip.set_answers(['set'])
+		# An input_function given to the call beats answers set for every call
+		self.assertEqual(clip.prompt('?', input_function=lambda _: 'given'), 'given')
+		self.assertTrue(clip.confirm('?', input_function=lambda _: 'y'))
+		self.assertEqual(clip.prompt('?', input_function=lambda _: 'given', answers=['own']), 'own')
+		self.assertEqual(clip.prompt('?'), 'set')
+		app, _, _ = self.embed()
+
+		@app.main()
+		def f():
+			clip.echo(clip.prompt('Name?', input_function=lambda _: 'Joe'))
+
+		self.assertEqual(clip.Runner().invoke(app, []).stdout, 'Joe\n')
+
+	def test_sequence(self):
+		clip.set_answers(iter(['n', '', 'bob']))
+		self.assertFalse(clip.confirm('?'))
+		self.assertEqual(clip.prompt('?', default='al'), 'al')
+		self.assertEqual(clip.prompt('?'), 'bob')
+
+	def test_file(self):
+		path = self.write_file('{"Continue?": "y"}', '.json')
+		self.assertTrue(clip.confirm('Continue?', answers=path))
+
+	def test_fail_fast(self):
+		_, _, err = self.embed()
+		clip.set_answers({'Number': 'nope'})
+		with self.assertRaises(clip.ClipExit):
+			clip.prompt('Missing')
+		with self.assertRaises(clip.ClipExit):
+			clip.prompt('Number', type=int)
+		self.assertTrue('No scripted answer' in err._writes[0])
+		self.assertTrue('Invalid scripted answer' in err._writes[1])
+
+
 class TestParse(BaseTest):
 
 	def test_kitchen_sink(self):
@@ -168,6 +269,32 @@ class TestParse(BaseTest):
 		for actual in actuals:
 			self.assertEqual(self.make_kitchen_sink_app().parse(actual.split()), expected)
 
+	def test_attached_values(self):
+		app = clip.App()
+
+		@app.main()
+		@clip.opt('-o', '--opt')
+		@clip.opt('-n', nargs=2)
+		@clip.flag('-a')
+		@clip.flag('-b')
+		def f(opt, n, a, b):
+			pass
+
+		self.assertEqual(app.parse(['-ovalue', '-ab', '-nx', 'y']),
+				{'opt': 'value', 'n': ['x', 'y'], 'a': True, 'b': True})
+		app.reset()
+		self.assertEqual(app.parse(['--opt=a=b', '-bn', '-ab']),
+				{'opt': 'a=b', 'n': ['-a', '-b'], 'a': False, 'b': True})
+
+	def test_token_stream(self):
+		tokens = clip.TokenStream(iter(['-ab', 'c', 'd']))
+		self.assertTrue(tokens.globbed())
+		self.assertEqual(len(tokens), 4)
+		self.assertEqual(tokens.pop(0), '-a')
+		self.assertEqual(tokens.take(2), ['-b', 'c'])
+		self.assertIsNone(tokens.take(2))
+		self.assertFalse(tokens)
+
 	def test_required(self):
 		app, _, err = self.embed()
 
@@ -206,6 +333,39 @@ class TestParse(BaseTest):
 			self.assertTrue(e in err._writes[i])
 
 
+class TestSplit(BaseTest):
+	'''clip.split() must agree with shlex.split() on every input.
+	'''
+
+	def assertSplitsLikeShlex(self, s):
+		try:
+			expected = shlex.split(s)
+		except ValueError as e:
+			with self.assertRaises(ValueError):
+				clip.split(s)
+		else:
+			self.assertEqual(clip.split(s), expected, repr(s))
+
+	def test_common(self):
+		for s in ['', '   ', 'add cookies -q 10', '--to-err "two words"', "it's' 'fine",
+		          '"a \\"quoted\\" word"', "'single \\ quotes'", 'escaped\\ space',
+		          '""', "''", 'a"b"c\'d\'e', '"\\x \\\\ \\$"',
+		          'tab\tsep\nlines\r\n', 'vertical\x0btab', '# not a comment']:
+			self.assertSplitsLikeShlex(s)
+		# Python 2's shlex can't take unicode, so this one is spelled out
+		self.assertEqual(clip.split(u'caf\xe9 "\u4f60\u597d"'), [u'caf\xe9', u'\u4f60\u597d'])
+
+	def test_errors(self):
+		for s in ['"unterminated', "'unterminated", 'trailing\\', 'a "b\\"']:
+			self.assertSplitsLikeShlex(s)
+
+	def test_random(self):
+		rng = random.Random(0)
+		alphabet = ' \t\n\'"\\ab-=#\x0b'
+		for _ in range(5000):
+			self.assertSplitsLikeShlex(''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))))
+
+
 class TestInvoke(BaseTest):
 
 	def test_invoke(self):
@@ -221,6 +381,22 @@ class TestInvoke(BaseTest):
 		app.run('b o o p')
 		self.assertEqual(self.b[2], 'o o p'.split())
 
+	def test_reset_touched_only(self):
+		app = self.make_kitchen_sink_app()
+
+		@app._main.subcommand()
+		@clip.flag('-z')
+		def c(z):
+			pass
+
+		app.parse(['x', 'b', 'y'])
+		self.assertEqual(app._touched, [app._main, app._main._subcommands['b']])
+		c._params['z']._value = 'untouched'
+		app.reset()
+		self.assertEqual(app._touched, [])
+		self.assertEqual(c._params['z'].value(), 'untouched')
+		self.assertFalse(app._main._subcommands['b']._params['args'].satisfied())
+
 	def test_run(self):
 		app, out, err = self.make_embedded_app()
 		app.run(['--to-out', 'list']).run('--to-out string').run('--to-err "two words"')
@@ -269,6 +445,48 @@ class TestInvoke(BaseTest):
 		app.run('').run('--name Dave')
 		self.assertEqual(out._writes, ['No name provided\n', 'Hello Dave!\n'])
 
+	def test_lazy_default(self):
+		app, out, _ = self.embed()
+		calls = []
+
+		def fn():
+			calls.append(1)
+			return 'Joe'
+
+		@app.main()
+		@clip.opt('--name', default=fn, lazy=True)
+		@clip.flag('--greet')
+		def f(name, greet):
+			if greet:
+				clip.echo('Hello {}{}!'.format(name(), name()))
+
+		app.run('')
+		self.assertEqual(calls, [])
+		app.run('--greet')
+		self.assertEqual(calls, [1])
+		self.assertEqual(out._writes, ['Hello JoeJoe!\n'])
+
+	def test_cached_default(self):
+		app, _, _ = self.embed()
+		calls = []
+
+		def fn():
+			calls.append(1)
+			return len(calls)
+
+		@app.main()
+		@clip.opt('--eager', default=fn, cache_ttl=60)
+		def f(eager):
+			self.assertEqual(eager, 1)
+
+		app.run('').run('').run('')
+		self.assertEqual(calls, [1])
+		# Expire the cache, forcing the default to be recomputed
+		app._main._params['eager']._cached = (1, 0)
+		with self.assertRaises(AssertionError):
+			app.run('')
+		self.assertEqual(calls, [1, 1])
+
 
 class TestCommand(BaseTest):
 
@@ -287,6 +505,48 @@ class TestCommand(BaseTest):
 		self.assertEqual(out._writes, ['x invoked!\n', 'x invoked!\n'])
 
 
+class TestTreeView(BaseTest):
+
+	def make_tree(self):
+		app, out, _ = self.embed()
+
+		@app.main()
+		def a():
+			pass
+
+		for name in ['d', 'b', 'c']:
+			@a.subcommand(name=name)
+			def sub():
+				pass
+
+		b = a._subcommands['b']
+
+		@b.subcommand()
+		def e():
+			pass
+
+		return a
+
+	def test_render_tree(self):
+		a = self.make_tree()
+		self.assertEqual(a.render_tree(), 'a\n  b\n    e\n  c\n  d')
+		self.assertEqual(a.render_tree(max_depth=1), 'a\n  b\n  c\n  d')
+		self.assertEqual(a.render_tree(include=lambda e: e.name() != 'b'), 'a\n  c\n  d')
+		# Adding a subcommand anywhere below invalidates the cached tree
+		e = a._subcommands['b']._subcommands['e']
+		@e.subcommand()
+		def f():
+			pass
+		self.assertEqual(a.render_tree(), 'a\n  b\n    e\n      f\n  c\n  d')
+
+	def test_deep_tree(self):
+		a = self.make_tree()
+		cmd = a
+		for i in range(sys.getrecursionlimit() + 100):
+			cmd = cmd.subcommand(name='s{}'.format(i))(lambda: None)
+		self.assertEqual(len(a.render_tree().split('\n')), sys.getrecursionlimit() + 105)
+
+
 class TestHelp(BaseTest):
 
 	def test_basic_help(self):
@@ -344,6 +604,56 @@ Subcommands:
 So long and thanks for all the fish!
 ''')
 
+	def make_big_app(self, n, **attrs):
+		app, out, _ = self.embed(**attrs)
+
+		@app.main(description='Lots of options')
+		def f(**kwargs):
+			pass
+
+		for i in range(n):
+			clip.opt('--option-{}'.format(i), help='Option number {}'.format(i))(f)
+		return app, out
+
+	def test_streamed_help(self):
+		app, out = self.make_big_app(2500)
+		with self.assertRaises(clip.ClipExit):
+			app.run('-h')
+		self.assertGreater(len(out._writes), 1)
+		text = ''.join(out._writes)
+		lines = text.split('\n')
+		self.assertEqual(lines[:4], ['f: Lots of options', '', 'Usage: f {{options}}', ''])
+		self.assertEqual(lines[6], '  --option-0 [text]     Option number 0')
+		self.assertEqual(lines[-2], '  --option-2499 [text]  Option number 2499')
+		self.assertEqual(text, '\n'.join(app._main._help_lines()) + '\n')
+
+	def test_help_lines_are_lazy(self):
+		app, _ = self.make_big_app(10)
+		calls = []
+		for p in app._main._params.options():
+			p._get_help = (lambda f: lambda: calls.append(True) or f())(p._get_help)
+		lines = app._main._help_lines()
+		self.assertEqual(next(lines), 'f: Lots of options')
+		self.assertEqual(calls, [])
+
+	def test_pager(self):
+		app, out = self.make_big_app(100, pager=True)
+		out.isatty = lambda: True
+		path = self.write_file()
+		pager = os.environ.get('PAGER')
+		os.environ['PAGER'] = 'cat > "{}"'.format(path)
+		try:
+			with self.assertRaises(clip.ClipExit):
+				app.run('-h')
+		finally:
+			if pager is None:
+				del os.environ['PAGER']
+			else:
+				os.environ['PAGER'] = pager
+		with open(path) as f:
+			self.assertEqual(f.read(), '\n'.join(app._main._help_lines()) + '\n')
+		self.assertEqual(out._writes, [])
+
 
 class TestInheritance(BaseTest):
 
@@ -449,6 +759,932 @@ class TestEmbedding(BaseTest):
 		self.assertEqual(self.cache, '? [42]: ')
 
 
+class TestRouter(BaseTest):
+
+	def make_app(self, name, calls):
+		app, out, err = self.embed()
+
+		@app.main(name=name)
+		@clip.arg('words', nargs=-1)
+		def f(words):
+			calls.append((name, words))
+			clip.echo(' '.join(words))
+
+		return app, out
+
+	def test_dispatch(self):
+		calls = []
+		router = clip.Router()
+		app1, out1 = self.make_app('app1', calls)
+		app2, out2 = self.make_app('app2', calls)
+		router.add('app1', app1)
+		router.add('app2', app2)
+		router.run('app2 a b')
+		router.run(['app1', 'c'])
+		self.assertEqual(calls, [('app2', ['a', 'b']), ('app1', ['c'])])
+		# Echoes are scoped to the app being run instead of broadcast
+		self.assertEqual(out1._writes, ['c\n'])
+		self.assertEqual(out2._writes, ['a b\n'])
+		self.assertIn('app1', router)
+		self.assertEqual(len(router), 2)
+
+	def test_lazy_factory(self):
+		calls = []
+		built = []
+		router = clip.Router(separator=':')
+
+		@router.route('lazy')
+		def factory():
+			built.append(True)
+			return self.make_app('lazy', calls)[0]
+
+		self.assertEqual(built, [])
+		router.run('lazy x')
+		router.run('lazy:y z')
+		self.assertEqual(built, [True])
+		self.assertEqual(calls, [('lazy', ['x']), ('lazy', ['y', 'z'])])
+		self.assertEqual(router.names(), ['lazy'])
+
+	def test_unknown_app(self):
+		err = Stream()
+		router = clip.Router(stderr=err)
+		with self.assertRaises(clip.ClipExit) as cm:
+			router.run('nope')
+		self.assertEqual(cm.exception.status, 1)
+		self.assertEqual(err._writes, ['Error: No app named "nope".\n'])
+		with self.assertRaises(clip.ClipExit):
+			router.run([])
+
+	def test_many_apps(self):
+		calls = []
+		router = clip.Router()
+		for i in range(1000):
+			router.route('t{}'.format(i))(lambda i=i: self.make_app('t{}'.format(i), calls)[0])
+		router.run('t999 hi')
+		self.assertEqual(calls, [('t999', ['hi'])])
+		# Only the app that was dispatched to was ever built
+		self.assertEqual(len(clip.clip_globals._streams), 1)
+
+
+class TestMiddleware(BaseTest):
+
+	def make_app(self):
+		app, out, err = self.embed()
+		self.calls = []
+
+		@app.main()
+		@clip.opt('-n', type=int, default=1)
+		def a(n):
+			self.calls.append(('a', n))
+
+		@a.subcommand()
+		@clip.arg('x')
+		def b(x):
+			self.calls.append(('b', x))
+
+		return app
+
+	def test_chain(self):
+		app = self.make_app()
+		seen = []
+
+		def outer(call_next, command, parsed):
+			seen.append(('outer', command.name(), dict(parsed)))
+			return call_next(parsed)
+
+		def inner(call_next, command, parsed):
+			seen.append(('inner', command.name()))
+			if command.name() == 'b':
+				parsed = dict(parsed, x=parsed['x'].upper())
+			return call_next(parsed)
+
+		app._main._subcommands['b'].use(inner)
+		app.use(outer)
+		app.run('-n 3 b hi')
+		self.assertEqual(self.calls, [('a', 3), ('b', 'HI')])
+		self.assertEqual(seen, [
+			('outer', 'a', {'n': 3, 'b': {'x': 'hi'}}),
+			('outer', 'b', {'x': 'hi'}),
+			('inner', 'b')
+		])
+
+	def test_no_middleware(self):
+		app = self.make_app()
+		self.assertIsNone(app._main._chain)
+		self.assertIsNone(app._main._subcommands['b']._chain)
+
+	def test_retry(self):
+		app, _, _ = self.embed()
+		attempts = []
+
+		def retry(call_next, command, parsed):
+			for _ in range(3):
+				try:
+					return call_next(parsed)
+				except ValueError:
+					pass
+
+		app.use(retry)
+
+		@app.main()
+		def f():
+			attempts.append(True)
+			if len(attempts) < 3:
+				raise ValueError
+
+		app.run([])
+		self.assertEqual(len(attempts), 3)
+
+	def test_latency_histogram(self):
+		app = self.make_app()
+		hist = app.use(clip.LatencyHistogram(buckets=[0.5, 1.0]))
+		app.run('b x')
+		app.run('b y')
+		snapshot = hist.snapshot()
+		self.assertEqual(sorted(snapshot), ['a', 'a b'])
+		self.assertEqual(snapshot['a b']['count'], 2)
+		self.assertEqual(snapshot['a b']['buckets'], [(0.5, 2), (1.0, 2), (float('inf'), 2)])
+		hist.record('a', 2.0)
+		self.assertEqual(hist.snapshot()['a']['buckets'][-2:], [(1.0, 2), (float('inf'), 3)])
+
+	def test_slow_command_logger(self):
+		app = self.make_app()
+		messages = []
+
+		class Logger(object):
+			def warning(self, message, *args):
+				messages.append(message % args)
+
+		app.use(clip.SlowCommandLogger(threshold=-1, logger=Logger()))
+		app.run('b x')
+		self.assertEqual(len(messages), 2)
+		self.assertTrue(messages[1].startswith('Command "a b" took '))
+
+
+@unittest.skipUnless(has_module('concurrent.futures'), 'Needs concurrent.futures')
+class TestFanout(BaseTest):
+
+	def make_app(self, **attrs):
+		app, out, err = self.embed()
+
+		@app.main()
+		@clip.flag('-q', '--quiet')
+		@clip.arg('words', nargs=-1, fanout='thread', **attrs)
+		def f(quiet, words):
+			if words == 'bad':
+				raise ValueError('bad word')
+			if words == 'quit':
+				clip.exit('quitting', True)
+			if not quiet:
+				clip.echo(words)
+				clip.echo(words.upper(), err=True)
+
+		return app, out, err
+
+	def test_ordered(self):
+		app, out, err = self.make_app(workers=4)
+		app.run('a b c d')
+		self.assertEqual(out._writes, ['a\n', 'b\n', 'c\n', 'd\n'])
+		self.assertEqual(err._writes, ['A\n', 'B\n', 'C\n', 'D\n'])
+
+	def test_as_completed(self):
+		app, out, _ = self.make_app(ordered=False)
+		app.run('a b c d')
+		self.assertEqual(sorted(out._writes), ['a\n', 'b\n', 'c\n', 'd\n'])
+
+	def test_failures(self):
+		app, out, err = self.make_app()
+		with self.assertRaises(clip.ClipExit) as cm:
+			app.run('a bad quit b')
+		self.assertEqual(cm.exception.status, 1)
+		self.assertEqual(out._writes, ['a\n', 'b\n'])
+		self.assertEqual(err._writes, [
+			'A\n',
+			'Error: "bad" failed with ValueError: bad word\n',
+			'quitting\n',
+			'B\n',
+			'Error: 2 of 4 calls to "f" failed.\n'
+		])
+
+	def test_middleware(self):
+		app, out, _ = self.make_app()
+		calls = []
+
+		@app.use
+		def record(call_next, command, parsed):
+			calls.append(parsed['words'])
+			return call_next(parsed)
+
+		app.run('a b c')
+		# Middleware wraps the whole fan-out, once
+		self.assertEqual(calls, [['a', 'b', 'c']])
+		self.assertEqual(out._writes, ['a\n', 'b\n', 'c\n'])
+
+	def test_process(self):
+		from .pickling_fixtures import square_all
+		_, out, _ = self.embed()
+		square_all.invoke(square_all.parse(['1', '2', '3']))
+		self.assertEqual(out._writes, ['1\n', '4\n', '9\n'])
+		square_all.reset()
+
+
+class TestTimeout(BaseTest):
+
+	def make_app(self, app_timeout=None, timeout=None):
+		app, out, err = self.embed(timeout=app_timeout)
+		self.stopped = []
+
+		@app.main(timeout=timeout)
+		@clip.opt('-s', '--seconds', type=float, default=0)
+		def f(seconds):
+			if seconds < 0:
+				raise ValueError('negative')
+			deadline = time.time() + seconds
+			while time.time() < deadline:
+				if clip.cancelled():
+					self.stopped.append(True)
+					return
+				time.sleep(0.001)
+			clip.echo('done')
+
+		return app, out, err
+
+	def assert_times_out(self, app, err, message):
+		with self.assertRaises(clip.ClipExit) as cm:
+			app.run('-s 5')
+		self.assertEqual(cm.exception.status, clip.TIMEOUT_STATUS)
+		self.assertEqual(err._writes, [message])
+		# The callback is told to stop, and the app can run again
+		for _ in range(500):
+			if self.stopped:
+				break
+			time.sleep(0.01)
+		self.assertEqual(self.stopped, [True])
+		app.run('-s 0')
+
+	def test_command_timeout(self):
+		app, out, _ = self.make_app(timeout=10)
+		app.run('-s 0.001')
+		self.assertEqual(out._writes, ['done\n'])
+		# Long enough for a callback that returns right away to finish in time
+		app, out, err = self.make_app(timeout=0.2)
+		self.assert_times_out(app, err, 'Error: Command "f" timed out after 0.2s.\n')
+
+	def test_app_timeout(self):
+		app, out, err = self.make_app(app_timeout=0.2)
+		self.assert_times_out(app, err, 'Error: App "f" timed out after 0.2s.\n')
+
+	def test_errors_propagate(self):
+		app, _, _ = self.make_app(timeout=1)
+		with self.assertRaises(ValueError):
+			app.run('-s -1')
+
+	def test_not_cancelled(self):
+		self.assertFalse(clip.cancelled())
+		parent = clip.CancelToken()
+		token = clip.CancelToken(parent)
+		parent.cancel()
+		self.assertTrue(token.cancelled())
+
+	@unittest.skipUnless(has_module('asyncio'), 'Needs asyncio')
+	def test_run_async(self):
+		import asyncio
+		app, out, _ = self.make_app(timeout=1)
+		loop = asyncio.new_event_loop()
+		try:
+			loop.run_until_complete(app.run_async(['-s', '0.001'], loop=loop))
+			# Without a loop given, the running one is used
+			futures = []
+			loop.call_soon(lambda: futures.append(app.run_async(['-s', '0.001'])))
+			loop.run_until_complete(asyncio.sleep(0))
+			loop.run_until_complete(futures[0])
+		finally:
+			loop.close()
+		self.assertEqual(out._writes, ['done\n', 'done\n'])
+
+
+class TestCaptureStreams(BaseTest):
+
+	def test_capture_stream(self):
+		out, err = clip.CaptureStream(), clip.CaptureStream()
+		app = clip.App(stdout=out, stderr=err)
+
+		@app.main()
+		@clip.arg('words', nargs=-1)
+		def f(words):
+			for w in words:
+				clip.echo(w)
+			clip.echo('done', err=True)
+
+		app.run('a b c')
+		self.assertEqual(out.getvalue(), 'a\nb\nc\n')
+		self.assertEqual(err.getvalue(), 'done\n')
+		out.clear()
+		self.assertEqual(out.getvalue(), '')
+
+	def test_ring_stream(self):
+		ring = clip.RingStream(8)
+		ring.write('abc')
+		self.assertEqual(ring.getvalue(), 'abc')
+		self.assertFalse(ring.truncated)
+		ring.write('defghij')
+		self.assertEqual(ring.getvalue(), 'cdefghij')
+		self.assertTrue(ring.truncated)
+		self.assertEqual(ring.dropped, 2)
+		# Characters cut in half at the start are left out
+		ring.write(u'\u00e9' * 5)
+		self.assertEqual(ring.getvalue(), u'\u00e9' * 4)
+		# A write larger than the buffer still counts all of its bytes
+		ring.clear()
+		ring.write('ab')
+		ring.write(u'\u00e9' * 100 + 'xyz')
+		self.assertEqual(ring.getvalue(), u'\u00e9' * 2 + 'xyz')
+		self.assertEqual(ring.dropped, 2 + 200 + 3 - 8)
+		ring.clear()
+		self.assertEqual(ring.getvalue(), '')
+		with self.assertRaises(ValueError):
+			clip.RingStream(0)
+
+	def test_ring_stream_random(self):
+		rand = random.Random(7)
+		for size in [1, 5, 64, 1000]:
+			ring = clip.RingStream(size)
+			written = []
+			for _ in range(300):
+				written.append('x' * rand.randint(0, 30) + str(rand.randint(0, 9)))
+				ring.write(written[-1])
+			expected = ''.join(written)
+			self.assertEqual(ring.getvalue(), expected[-size:])
+			self.assertEqual(ring.dropped, max(0, len(expected) - size))
+
+
+class TestRunner(BaseTest):
+
+	def make_app(self):
+		app, _, _ = self.embed()
+
+		@app.main()
+		@clip.flag('--ask')
+		@clip.opt('--fail')
+		@clip.arg('words', nargs=-1)
+		def f(ask, fail, words):
+			clip.echo(' '.join(words))
+			if ask:
+				clip.echo(clip.prompt('Name?'), err=True)
+			if fail == 'exit':
+				clip.exit('Failed!', True)
+			if fail == 'raise':
+				raise ValueError('whoops')
+
+		return app
+
+	def test_invoke(self):
+		app = self.make_app()
+		runner = clip.Runner()
+		result = runner.invoke(app, 'a b')
+		self.assertEqual((result.stdout, result.stderr, result.status), ('a b\n', '', 0))
+		result = runner.invoke(app, ['--fail', 'exit', 'c'])
+		self.assertEqual((result.stdout, result.stderr, result.status), ('c\n', 'Failed!\n', 1))
+		result = runner.invoke(app, '--fail raise')
+		self.assertEqual(result.status, 1)
+		self.assertIsInstance(result.exception, ValueError)
+
+	def test_answers(self):
+		app = self.make_app()
+		result = clip.Runner(answers=['Joe']).invoke(app, '--ask')
+		self.assertEqual(result.stderr, 'Joe\n')
+		result = clip.Runner().invoke(app, '--ask', answers={'Name?': 'Ann'})
+		self.assertEqual(result.stderr, 'Ann\n')
+		# With no scripted answer, prompts fail instead of waiting for input
+		result = clip.Runner().invoke(app, '--ask')
+		self.assertEqual(result.status, 1)
+		self.assertEqual(result.stderr, 'Error: No scripted answer for prompt "Name?".\n')
+
+	@unittest.skipUnless(has_module('concurrent.futures'), 'Needs concurrent.futures')
+	def test_fanout(self):
+		app, out, _ = self.embed()
+
+		@app.main()
+		@clip.arg('names', nargs=-1, fanout='thread', workers=2)
+		def f(names):
+			clip.echo('{} {}'.format(names, clip.prompt(names)))
+
+		result = clip.Runner(answers={'a': 1, 'b': 2}).invoke(app, 'a b')
+		self.assertEqual((result.stdout, result.status), ('a 1\nb 2\n', 0))
+		self.assertEqual(out._writes, [])
+
+	def test_isolated(self):
+		# Broadcast echoes from other threads don't leak into a run
+		apps = [self.make_app() for _ in range(8)]
+		results = {}
+
+		def run(i):
+			for j in range(20):
+				results[i, j] = clip.Runner().invoke(apps[i], [str(i), str(j)])
+
+		threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		for (i, j), result in results.items():
+			self.assertEqual(result.stdout, '{} {}\n'.format(i, j))
+
+
+class TestConverters(BaseTest):
+
+	def test_constraints(self):
+		app, out, err = self.embed()
+
+		@app.main()
+		@clip.opt('-c', type=int, choices=[1, 2, 3])
+		@clip.opt('-r', type=float, min=0, max=1)
+		@clip.opt('-n', min=1)  # Without a type, values are converted like the bound
+		@clip.arg('words', nargs=-1, choices=['a', 'b'])
+		def f(c, r, n, words):
+			pass
+
+		self.assertEqual(app.parse(['-c', '2', '-r', '0.5', '-n', '3', 'a', 'b', 'a']),
+			{'c': 2, 'r': 0.5, 'n': 3, 'words': ['a', 'b', 'a']})
+		app.reset()
+		for tokens, message in [
+			(['-c', '4'], 'Error: Invalid value given to "c", expected one of 1, 2, 3.\n'),
+			(['-c', 'x'], 'Error: Invalid type given to "c", expected int.\n'),
+			(['-r', '-1'], 'Error: Invalid value given to "r", expected at least 0.\n'),
+			(['-r', '2'], 'Error: Invalid value given to "r", expected at most 1.\n'),
+			(['-n', '0'], 'Error: Invalid value given to "n", expected at least 1.\n'),
+			(['a', 'c'], 'Error: Invalid value given to "words", expected one of a, b.\n')
+		]:
+			err._writes = []
+			with self.assertRaises(clip.ClipExit):
+				app.run(tokens)
+			self.assertEqual(err._writes, [message])
+
+	def test_path_exists(self):
+		d = tempfile.mkdtemp()
+		path = os.path.join(d, 'file')
+		convert = clip.compile_converter(path_exists=True, stat_cache=60)
+		with self.assertRaises(ValueError):
+			convert(path)
+		open(path, 'w').close()
+		# The missing path is cached until the stat cache expires
+		with self.assertRaises(ValueError):
+			convert(path)
+		self.assertEqual(clip.compile_converter(path_exists=True)(path), path)
+		os.remove(path)
+		os.rmdir(d)
+
+	def test_registry(self):
+		self.assertIs(clip.compile_converter(int), int)
+		self.assertIsNone(clip.compile_converter())
+		self.assertIs(clip.compile_converter(int, choices=[1, 2]), clip.compile_converter(int, choices=(2, 1)))
+
+	def test_help(self):
+		app, out, _ = self.embed()
+
+		@app.main()
+		@clip.opt('--mode', choices=['fast', 'slow'], help='How to go')
+		def f(mode):
+			pass
+
+		with self.assertRaises(clip.ClipExit):
+			app.run('-h')
+		self.assertIn('--mode [text]  How to go (choices: fast, slow)', out._writes[0])
+
+
+class TestSuggestions(BaseTest):
+
+	def assert_error(self, app, err, tokens, message):
+		err._writes = []
+		with self.assertRaises(clip.ClipExit):
+			app.run(tokens)
+		app.reset()
+		self.assertEqual(err._writes, [message + '\n'])
+
+	def test_did_you_mean(self):
+		app, _, err = self.embed()
+
+		@app.main()
+		@clip.opt('--verbose')
+		def a(verbose):
+			pass
+
+		@a.subcommand()
+		def status():
+			pass
+
+		self.assert_error(app, err, 'stats', 'Error: Could not understand "stats". Did you mean "status"?')
+		self.assert_error(app, err, '--verbos', 'Error: Could not understand "--verbos". Did you mean "--verbose"?')
+		self.assert_error(app, err, '--hepl', 'Error: Could not understand "--hepl". Did you mean "--help"?')
+		self.assert_error(app, err, 'nothing', 'Error: Could not understand "nothing".')
+		self.assert_error(app, err, '-s', 'Error: Could not understand "-s".')
+
+		# The index is rebuilt once the command changes
+		@app._main.subcommand()
+		def start():
+			pass
+
+		self.assert_error(app, err, 'strt', 'Error: Could not understand "strt". Did you mean "start"?')
+		clip.opt('--quantity')(app._main)
+		self.assert_error(app, err, '--quantty', 'Error: Could not understand "--quantty". Did you mean "--quantity"?')
+
+	def test_index(self):
+		rand = random.Random(3)
+		words = [''.join(rand.choice('abcde') for _ in range(rand.randint(1, 8))) for _ in range(300)]
+		index = clip._NgramIndex(words)
+		for _ in range(100):
+			word = ''.join(rand.choice('abcdef') for _ in range(rand.randint(1, 8)))
+			for limit in range(4):
+				found = min((clip.edit_distance(word, w), w) for w in words)
+				self.assertEqual(index.closest(word, limit), found[1] if found[0] <= limit else None)
+
+
+class TestPickling(BaseTest):
+
+	def test_round_trip(self):
+		from .pickling_fixtures import pickled_app
+		app = pickle.loads(pickle.dumps(pickled_app))
+		self.assertIsNot(app, pickled_app)
+		self.assertIn('pickled', clip.clip_globals._streams)
+		runner = clip.Runner()
+		self.assertEqual(runner.invoke(app, '-n 3 pickled_sub a b').stdout, 'main 3\nsub a b\n')
+		self.assertEqual(runner.invoke(app, '--tree').stdout, 'pickled_main\n  pickled_sub\n')
+		self.assertIn('Show this help message', runner.invoke(app, '-h').stdout)
+		result = runner.invoke(app, 'pickled_sub c')
+		self.assertEqual(result.stderr, 'Error: Invalid value given to "items", expected one of a, b.\n')
+
+	def test_streams(self):
+		out = clip.CaptureStream()
+		app = clip.App(stdout=out, name='capture')
+		app.echo('before')
+		data = pickle.dumps(app)
+		# With the name free, loading registers the pickled streams
+		clip.clip_globals._streams = {}
+		pickle.loads(data)
+		loaded = clip.clip_globals._streams['capture']['out']
+		self.assertIsInstance(loaded, clip.CaptureStream)
+		self.assertIsNot(loaded, out)
+		self.assertEqual(loaded.getvalue(), 'before\n')
+		clip.clip_globals._streams = {}
+		app = pickle.loads(pickle.dumps(clip.App(name='standard')))
+		self.assertIs(clip.clip_globals._streams['standard']['out'], sys.stdout)
+
+	def test_middleware(self):
+		from .pickling_fixtures import pickled_app
+		hist = pickled_app.use(clip.LatencyHistogram())
+		try:
+			app = pickle.loads(pickle.dumps(pickled_app))
+			clip.Runner().invoke(app, 'pickled_sub a')
+			self.assertEqual(sorted(app._middleware[0].snapshot()), ['pickled_main', 'pickled_main pickled_sub'])
+		finally:
+			del pickled_app._middleware[:]
+			for cmd in pickled_app._main._walk():
+				cmd._compose()
+
+	def test_nested_callback(self):
+		app, _, _ = self.embed()
+
+		@app.main()
+		def f():
+			pass
+
+		with self.assertRaises((AttributeError, TypeError, pickle.PicklingError)):
+			pickle.dumps(app)
+
+	def test_shadowed_callback(self):
+		app, _, _ = self.embed()
+
+		def pickled_main():
+			pass
+
+		# Its name leads to the other pickled_main, which must not be used instead
+		pickled_main.__module__ = 'tests.pickling_fixtures'
+		pickled_main.__qualname__ = 'pickled_main'
+		app.main()(pickled_main)
+		with self.assertRaises(TypeError):
+			clip._CallbackRef(pickled_main)
+		with self.assertRaises((TypeError, pickle.PicklingError)):
+			pickle.dumps(app)
+
+	@unittest.skipIf(sys.version_info < (3, 7), 'Needs ProcessPoolExecutor(mp_context=...)')
+	def test_spawn(self):
+		import concurrent.futures
+		import multiprocessing
+		from .pickling_fixtures import pickled_app, run_pickled
+		context = multiprocessing.get_context('spawn')
+		with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+			self.assertEqual(pool.submit(run_pickled, pickled_app, '-n 2 pickled_sub b').result(), 'main 2\nsub b\n')
+
+
+class TestMemoryReport(BaseTest):
+
+	def test_report(self):
+		app, _, _ = self.embed()
+
+		@app.main(description='Main command')
+		@clip.opt('--big', default='x' * 10000)
+		@clip.opt('--shared', help='Inherited by every subcommand')
+		def a(big, shared):
+			pass
+
+		for i in range(20):
+			@a.subcommand(name='sub{}'.format(i), inherits=['shared'])
+			@clip.arg('items', nargs=-1, help='Items {} '.format(i) * 100)
+			def sub(items, shared):
+				pass
+
+		report = app.memory_report()
+		commands = report['commands']
+		self.assertEqual(len(commands), 21)
+		self.assertGreater(commands['a']['defaults'], 10000)
+		self.assertGreater(commands['a sub3']['help'], 600)
+		for row in commands.values():
+			self.assertEqual(row['total'], sum(row[k] for k in ['parameters', 'help', 'subcommands', 'defaults', 'command']))
+		self.assertEqual(report['total'], commands['a']['subtree'])
+		self.assertEqual(report['total'], sum(row['total'] for row in commands.values()))
+		# Adding subcommands grows the report
+		app._main.subcommand(name='another')(lambda: None)
+		self.assertGreater(app.memory_report()['total'], report['total'])
+
+	def test_streams(self):
+		app, _, _ = self.make_embedded_app()
+		gone = clip.App(name='gone', stdout=clip.CaptureStream())
+		gone.echo('x' * 5000)
+		del gone
+		gc.collect()
+		streams = app.memory_report()['streams']
+		self.assertEqual(streams['stale'], ['gone'])
+		self.assertGreater(streams['entries']['gone'], 5000)
+		self.assertIn(app._name, streams['entries'])
+
+	@unittest.skipUnless(has_module('tracemalloc'), 'Needs tracemalloc')
+	def test_verify(self):
+		app = self.make_kitchen_sink_app()
+		report = app.memory_report(verify=True)
+		# The copy comes with allocator overhead, but should be about the same size
+		self.assertGreater(report['traced'], report['total'] / 2)
+		self.assertLess(report['traced'], report['total'] * 3)
+
+
+class TestRecordReplay(BaseTest):
+
+	def setUp(self):
+		super(TestRecordReplay, self).setUp()
+		self.path = self.write_file(suffix='.jsonl')
+
+	def make_app(self, **attrs):
+		app, out, err = self.embed(**attrs)
+
+		@app.main()
+		@clip.opt('--sleep', type=float, default=0)
+		@clip.arg('words', nargs=-1)
+		def f(sleep, words):
+			time.sleep(sleep)
+			clip.echo(' '.join(words))
+
+		return app, out, err
+
+	def test_record(self):
+		app, out, err = self.make_app(record=self.path)
+		app.run(u'hello w\u00f6rld')
+		with self.assertRaises(clip.ClipExit):
+			app.run('--sleep')
+		self.assertEqual(out._writes, [u'hello w\u00f6rld\n'])
+		first, second = clip.read_records(self.path)
+		self.assertEqual(first['tokens'], ['hello', u'w\u00f6rld'])
+		self.assertEqual(first['parsed'], {'sleep': 0, 'words': ['hello', u'w\u00f6rld']})
+		self.assertEqual(first['status'], 0)
+		self.assertEqual(first['output_bytes'], 13)
+		self.assertGreaterEqual(first['duration'], 0)
+		self.assertEqual(second['tokens'], ['--sleep'])
+		self.assertIsNone(second['parsed'])
+		self.assertEqual(second['status'], 1)
+		self.assertGreater(second['output_bytes'], 0)
+
+	def test_record_interrupted(self):
+		app, _, _ = self.make_app(record=self.path)
+
+		@app._main.use
+		def interrupt(call_next, command, parsed):
+			raise KeyboardInterrupt()
+
+		with self.assertRaises(KeyboardInterrupt):
+			app.run('a')
+		record, = clip.read_records(self.path)
+		self.assertEqual(record['status'], 1)
+
+	def test_replay(self):
+		app, _, _ = self.make_app(record=self.path)
+		for i in range(10):
+			app.run(['--sleep', '0.01', str(i)])
+		with self.assertRaises(clip.ClipExit):
+			app.run('--sleep')
+		replayer, out, _ = self.make_app()
+		report = clip.replay(replayer, self.path, concurrency=4)
+		self.assertEqual(report['runs'], 11)
+		self.assertEqual(report['errors'], 1)
+		self.assertEqual(report['mismatches'], 0)
+		self.assertEqual(report['statuses'], {0: 10, 1: 1})
+		self.assertGreaterEqual(report['latency']['p50'], 0.01)
+		self.assertLessEqual(report['latency']['p50'], report['latency']['p99'])
+		self.assertEqual(report['latency']['p99'], report['latency']['max'])
+		self.assertEqual(out._writes, [])
+		# Four threads get through the runs faster than one does
+		self.assertLess(report['duration'], clip.replay(replayer, self.path)['duration'])
+
+	def test_replay_recording_app(self):
+		app, _, _ = self.make_app(record=self.path)
+		for i in range(3):
+			app.run(str(i))
+		report = clip.replay(app, self.path, concurrency=2)
+		self.assertEqual(report['runs'], 3)
+		self.assertEqual(len(list(clip.read_records(self.path))), 3)
+		# Recording picks up again afterwards
+		app.run('3')
+		self.assertEqual(len(list(clip.read_records(self.path))), 4)
+
+	def test_rate(self):
+		app, _, _ = self.make_app(record=self.path)
+		for i in range(5):
+			app.run(str(i))
+		report = clip.replay(lambda: self.make_app()[0], self.path, rate=50, limit=4)
+		self.assertEqual(report['runs'], 4)
+		# Starts are spaced 20ms apart, so the last one starts after 60ms
+		self.assertGreaterEqual(report['duration'], 0.06)
+		self.assertAlmostEqual(report['throughput'], 4 / report['duration'])
+
+
+class TestMetrics(BaseTest):
+
+	def test_counts(self):
+		app, _, _ = self.embed()
+
+		@app.main(name='tool')
+		@clip.flag('-t', '--tree', callback=lambda v: app._main.tree_view(v) if v else None)
+		def tool(tree):
+			pass
+
+		@tool.subcommand()
+		@clip.arg('count', type=int, required=True)
+		def add(count):
+			if count < 0:
+				raise ValueError('negative')
+			if count == 0:
+				clip.exit('Nothing to add', True)
+
+		for tokens in ['add 1', 'add 2', '', 'add 0', 'add -1', '-h', 'add -h', '--tree',
+		               'ad 1', 'add', 'add x', 'add x']:
+			try:
+				app.run(tokens)
+			except (clip.ClipExit, ValueError):
+				pass
+		metrics = app.metrics()
+		self.assertEqual(metrics['invocations'], {'tool': 5, 'tool add': 4})
+		self.assertEqual(metrics['exits'], {0: 6, 1: 5})
+		self.assertEqual(metrics['exceptions'], 1)
+		self.assertEqual(metrics['parse_errors'], {
+			'unknown_token': 1, 'missing_parameter': 1, 'invalid_type': 2})
+		self.assertEqual(metrics['help'], {'tool': 1, 'tool add': 1})
+		self.assertEqual(metrics['tree_view'], {'tool': 1})
+		# The snapshot doesn't change along with the app
+		app.run('add 3')
+		self.assertEqual(metrics['exits'][0], 6)
+		self.assertEqual(app.metrics()['exits'][0], 7)
+
+	def test_interrupted(self):
+		app, _, _ = self.embed()
+
+		@app.main()
+		def f():
+			raise KeyboardInterrupt()
+
+		with self.assertRaises(KeyboardInterrupt):
+			app.run([])
+		self.assertEqual(app.metrics()['exits'], {})
+		self.assertEqual(app.metrics()['exceptions'], 1)
+
+	def test_prometheus(self):
+		app, _, _ = self.embed(name='my "app"')
+
+		@app.main(name='tool')
+		def tool():
+			pass
+
+		@tool.subcommand()
+		@clip.arg('count', type=int)
+		def add(count):
+			pass
+
+		app.run('add 1')
+		with self.assertRaises(clip.ClipExit):
+			app.run('add x')
+		text = app.prometheus()
+		self.assertTrue(text.endswith('\n'))
+		lines = text.splitlines()
+		self.assertIn('# TYPE clip_invocations_total counter', lines)
+		self.assertIn('clip_invocations_total{app="my \\"app\\"",command="tool add"} 1', lines)
+		self.assertIn('clip_exits_total{app="my \\"app\\"",status="1"} 1', lines)
+		self.assertIn('clip_parse_errors_total{app="my \\"app\\"",reason="invalid_type"} 1', lines)
+		self.assertIn('clip_exceptions_total{app="my \\"app\\""} 0', lines)
+		self.assertIn('# HELP app_config_loads_total Times the config file was parsed.',
+			app.prometheus(prefix='app').splitlines())
+
+
+class TestResponseFiles(BaseTest):
+
+	def make_app(self, response_files=True):
+		app, _, err = self.embed(response_files=response_files)
+
+		@app.main()
+		@clip.flag('-a')
+		@clip.flag('-b')
+		@clip.arg('words', nargs=-1)
+		def f(a, b, words):
+			pass
+
+		return app, err
+
+	def test_expand(self):
+		app, _ = self.make_app()
+		path = self.write_file('-ab\n\ntwo words\nthree')
+		self.assertEqual(app.parse(['@' + path, 'four']), {
+			'a': True,
+			'b': True,
+			'words': ['two words', 'three', 'four']
+		})
+		# Empty files cannot be memory-mapped, but should still work
+		app.reset()
+		self.assertEqual(app.parse(['@' + self.write_file()])['words'], [])
+
+	def test_disabled(self):
+		app, _ = self.make_app(response_files=False)
+		self.assertEqual(app.parse(['@nope'])['words'], ['@nope'])
+
+	def test_missing(self):
+		app, err = self.make_app()
+		with self.assertRaises(clip.ClipExit):
+			app.parse(['@/this/does/not/exist'])
+		self.assertTrue('Could not read response file' in err._writes[0])
+
+
+class TestExternalDefaults(BaseTest):
+
+	def make_app(self, config):
+		app, _, _ = self.embed(config=config)
+
+		@app.main()
+		@clip.opt('--count', type=int, envvar='CLIP_TEST_COUNT', config_key='main.count', default=1)
+		@clip.opt('--names', nargs=-1, envvar='CLIP_TEST_NAMES', config_key='main.names')
+		@clip.flag('--loud', envvar='CLIP_TEST_LOUD', config_key='main.loud')
+		def f(count, names, loud):
+			pass
+
+		return app
+
+	def test_envvar(self):
+		app = self.make_app(None)
+		os.environ.update(CLIP_TEST_COUNT='5', CLIP_TEST_NAMES='a b', CLIP_TEST_LOUD='yes')
+		try:
+			self.assertEqual(app.parse([]), {'count': 5, 'names': ['a', 'b'], 'loud': True})
+			app.reset()
+			# User input still takes precedence
+			self.assertEqual(app.parse(['--count', '6'])['count'], 6)
+		finally:
+			for k in ['CLIP_TEST_COUNT', 'CLIP_TEST_NAMES', 'CLIP_TEST_LOUD']:
+				del os.environ[k]
+
+	def test_json_config(self):
+		path = self.write_file('{"main": {"count": 3, "names": ["x", "y"]}}', '.json')
+		app = self.make_app(path)
+		self.assertEqual(app.parse([]), {'count': 3, 'names': ['x', 'y'], 'loud': False})
+		# Every parameter, including --help, fell back to its default
+		self.assertEqual(app.stats()['defaults'], 4)
+
+	def test_bad_config_values(self):
+		path = self.write_file('{"main": {"loud": 1}}', '.json')
+		self.assertTrue(self.make_app(path).parse([])['loud'])
+		for value in ['2', '[1, 2]']:
+			path = self.write_file('{"main": {"loud": %s}}' % value, '.json')
+			app = self.make_app(path)
+			with self.assertRaises(clip.ClipExit):
+				app.run([])
+			self.assertEqual(clip.clip_globals._streams[app._name]['err']._writes,
+				['Error: Invalid value given to "loud", expected true or false.\n'])
+
+	def test_ini_config(self):
+		path = self.write_file('[main]\ncount = 4\nnames = p q r\n', '.ini')
+		app = self.make_app(path)
+		for _ in range(3):
+			self.assertEqual(app.parse([])['count'], 4)
+			app.reset()
+		# The config file is only parsed again once it changes
+		self.assertEqual(app.stats()['config_loads'], 1)
+		with open(path, 'w') as f:
+			f.write('[main]\ncount = 10\n')
+		self.assertEqual(app.parse([]), {'count': 10, 'names': [], 'loud': False})
+		self.assertEqual(app.stats()['config_loads'], 2)
+
+
 class TestMistakes(BaseTest):
 	'''These are mistakes a programmer would make using clip.
 	'''
@@ -519,6 +1755,24 @@ class TestMistakes(BaseTest):
 			def f(a):
 				pass
 
+		# Lazy defaults only make sense for functions
+		with self.assertRaises(TypeError):
+			app = clip.App()
+
+			@app.main()
+			@clip.opt('-a', default='whoops', lazy=True)
+			def f(a):
+				pass
+
+		# Fanning out over anything but a list of values
+		with self.assertRaises(TypeError):
+			app = clip.App()
+
+			@app.main()
+			@clip.arg('a', fanout='thread')
+			def f(a):
+				pass
+
 	def test_argument_mistakes(self):
 		# Specifying more than one name for an argument
 		with self.assertRaises(TypeError):
@@ -0,0 +1,471 @@
+'''
+Differential fuzzing of clip's parser.
+
+Random command trees are described by plain "specs", built into real clip
+Apps, and fed random token streams. Every result is checked against a
+reference parser that interprets the spec directly and implements clip's
+documented parsing rules in the simplest possible way. Any optimization of
+App.parse must keep the two in agreement: same parse results, same ClipExit
+statuses and messages, and same output on each stream.
+
+Run it directly for a longer session and a report of parse times:
+
+    python -m tests.fuzz --iterations 20000 --seed 1
+'''
+import argparse
+import random
+
+import clip
+
+
+########################################
+# SPECS
+########################################
+
+HELP = {'kind': 'flag', 'decls': ('-h', '--help'), 'name': 'help', 'nargs': 0, 'type': bool,
+        'default': False, 'required': False, 'hidden': True, 'inherit_only': False,
+        'help': 'Show this help message and exit'}
+
+VALUES = ['x', 'yo', '3', '42', '-4', '-12', '0', 'two words', '-', '--', '--nope', '-=']
+
+
+def determine_type(t, default):
+	if t is not None:
+		return t
+	if isinstance(default, list):
+		return type(default[0]) if default else None
+	return None if default is None else type(default)
+
+def make_param(rng, kind, name, letters):
+	if kind == 'arg':
+		decls = (name,)
+	else:
+		decls = ('--{}'.format(name.replace('_', '-')),)
+		if letters and rng.random() < 0.7:
+			decls = ('-' + letters.pop(),) + decls
+		if rng.random() < 0.3:
+			decls = tuple(reversed(decls))
+	nargs = 0 if kind == 'flag' else rng.choice([1, 1, 1, 2, -1])
+	t = rng.choice([None, None, int])
+	if kind == 'flag':
+		default, t = False, bool
+	elif rng.random() < 0.4:
+		value = rng.choice([7, -2]) if t is int else rng.choice(['dflt', '9'])
+		default = value if nargs == 1 else [value] * (nargs if nargs > 0 else 2)
+	else:
+		default = None if nargs == 1 else []
+	return {
+		'kind': kind,
+		'decls': decls,
+		'name': name,
+		'nargs': nargs,
+		'type': determine_type(t, default),
+		'declared_type': t,
+		'default': default,
+		'required': rng.random() < 0.15,
+		'hidden': rng.random() < 0.1,
+		'inherit_only': rng.random() < 0.15,
+		'help': rng.choice([None, 'Some help for {}'.format(name)])
+	}
+
+def make_spec(rng, depth=0, ancestors=(), counter=None):
+	'''Generates a random command tree spec.
+	'''
+	counter = counter if counter is not None else [0]
+	def fresh(prefix):
+		counter[0] += 1
+		return '{}{}'.format(prefix, counter[0])
+	letters = list('abcdefgijklmnopqrstuvwxyz')
+	used = set(d for a in ancestors for p in a['params'] for d in p['decls'] if len(d) == 2)
+	letters = [c for c in letters if '-' + c not in used]
+	rng.shuffle(letters)
+	cmd = {
+		'name': fresh('c'),
+		'description': rng.choice([None, 'A command']),
+		'epilogue': rng.choice([None, None, 'The end']),
+		'params': [],
+		'inherits': [],
+		'subs': [],
+		'default': None,
+		'tree_view': None
+	}
+	for kind, k in [('arg', rng.randint(0, 2)), ('opt', rng.randint(0, 3)), ('flag', rng.randint(0, 3))]:
+		for _ in range(k):
+			cmd['params'].append(make_param(rng, kind, fresh('p'), letters))
+	if ancestors and rng.random() < 0.5:
+		candidates = [p for a in ancestors for p in a['params']]
+		if candidates:
+			p = rng.choice(candidates)
+			cmd['inherits'].append(rng.choice(p['decls'] + (p['name'],)))
+	flags = [p for p in cmd['params'] if p['kind'] == 'flag']
+	if flags and rng.random() < 0.3:
+		cmd['tree_view'] = rng.choice(flags)['decls'][0]
+	if depth < 3:
+		for _ in range(rng.choice([0, 0, 1, 2, 3])):
+			cmd['subs'].append(make_spec(rng, depth + 1, ancestors + (cmd,), counter))
+	if cmd['subs'] and rng.random() < 0.2:
+		cmd['default'] = rng.choice(cmd['subs'])['name']
+	return cmd
+
+def make_tokens(rng, spec):
+	'''Generates a random token stream that mostly makes sense for a spec.
+	'''
+	vocab = list(VALUES) + ['-h', '--help']
+	shorts = []
+	stack = [spec]
+	while stack:
+		cmd = stack.pop()
+		vocab.append(cmd['name'])
+		for p in cmd['params']:
+			vocab.extend(p['decls'] + (p['name'],))
+			shorts.extend(d[1] for d in p['decls'] if len(d) == 2)
+		stack.extend(cmd['subs'])
+	if shorts:
+		for _ in range(3):
+			vocab.append('-' + ''.join(rng.sample(shorts, min(len(shorts), rng.randint(2, 3)))))
+		vocab.append('-{}{}'.format(rng.choice(shorts), rng.choice(VALUES)))
+	longs = [d for d in vocab if d.startswith('--') and len(d) > 2]
+	if longs:
+		vocab.append('{}={}'.format(rng.choice(longs), rng.choice(VALUES)))
+	# Misspell a few names, which should get suggestions
+	names = [e for e in vocab if len(e) > 2]
+	for _ in range(2):
+		word = list(rng.choice(names))
+		i = rng.randrange(len(word))
+		word[i:i + rng.randint(0, 1)] = rng.choice(['', 'x', 'ab'])
+		vocab.append(''.join(word))
+	# Walk down the tree now and then, so deep subcommands actually get parsed
+	tokens = []
+	cmd = spec
+	for _ in range(rng.randint(0, 8)):
+		if cmd['subs'] and rng.random() < 0.3:
+			cmd = rng.choice(cmd['subs'])
+			tokens.append(cmd['name'])
+		else:
+			tokens.append(rng.choice(vocab))
+	return tokens
+
+
+########################################
+# BUILDING APPS FROM SPECS
+########################################
+
+def build_app(spec):
+	out, err = Capture(), Capture()
+	app = clip.App(stdout=out, stderr=err)
+
+	def build(spec, decorator):
+		def callback(**kwargs):
+			pass
+		for p in reversed(spec['params']):
+			attrs = {k: p[k] for k in ['nargs', 'default', 'required', 'hidden', 'inherit_only', 'help']}
+			attrs['type'] = p['declared_type']
+			if p['kind'] == 'flag':
+				clip.flag(*p['decls'], name=p['name'], hidden=p['hidden'], required=p['required'],
+				          inherit_only=p['inherit_only'], help=p['help'])(callback)
+			else:
+				make = clip.arg if p['kind'] == 'arg' else clip.opt
+				make(*p['decls'], name=p['name'], **attrs)(callback)
+		attrs = {k: spec[k] for k in ['description', 'epilogue', 'default', 'tree_view']}
+		if spec['inherits']:
+			attrs['inherits'] = spec['inherits']
+		cmd = decorator(name=spec['name'], **attrs)(callback)
+		for sub in spec['subs']:
+			build(sub, cmd.subcommand)
+		return cmd
+
+	build(spec, app.main)
+	return app, out, err
+
+
+class Capture(object):
+	def __init__(self):
+		self._writes = []
+
+	def write(self, message):
+		self._writes.append(message)
+
+	def text(self):
+		text = ''.join(self._writes)
+		self._writes = []
+		return text
+
+
+########################################
+# REFERENCE PARSER
+########################################
+
+class RefExit(Exception):
+	def __init__(self, message, status):
+		self.message = message or 'clip exiting with status {}'.format(status)
+		self.status = status
+
+
+def distance(a, b):
+	'''Levenshtein distance, straight from its recursive definition.
+	'''
+	memo = {}
+	def d(i, j):
+		if i == 0 or j == 0:
+			return i + j
+		if (i, j) not in memo:
+			memo[i, j] = min(d(i - 1, j) + 1, d(i, j - 1) + 1, d(i - 1, j - 1) + (a[i - 1] != b[j - 1]))
+		return memo[i, j]
+	return d(len(a), len(b))
+
+
+class RefCommand(object):
+	'''A command of the reference parser, interpreted straight from a spec.
+	'''
+
+	def __init__(self, spec, parent=None, tree_views=None):
+		self.tree_views = tree_views if tree_views is not None else {}
+		self.spec = spec
+		self.name = spec['name']
+		self.parent = parent
+		params = [dict(HELP, callback='help')] + list(spec['params'])
+		self.inherited = []
+		for e in spec['inherits']:
+			p = parent.lookup_inherited(e)
+			params.append(p)
+			self.inherited.append(p['name'])
+		self.args = [p for p in params if p['kind'] == 'arg']
+		self.opts = [p for p in params if p['kind'] != 'arg']
+		self.args_map, self.opts_map = {}, {}
+		for l, m in [(self.args, self.args_map), (self.opts, self.opts_map)]:
+			for i, p in enumerate(l):
+				for d in p['decls'] + (p['name'],):
+					m[d] = i
+		# The tree view always shows the tree of the command that declared it,
+		# even when its flag is inherited and matched by a subcommand
+		if spec['tree_view']:
+			self.tree_views[id(self.get(spec['tree_view']))] = self
+		self.subs = {}
+		for sub in spec['subs']:
+			self.subs[sub['name']] = RefCommand(sub, self, self.tree_views)
+
+	def get(self, key):
+		if key in self.args_map:
+			return self.args[self.args_map[key]]
+		return self.opts[self.opts_map[key]]
+
+	def lookup_inherited(self, key):
+		if key in self.args_map or key in self.opts_map:
+			return self.get(key)
+		return self.parent.lookup_inherited(key)
+
+	def path(self):
+		return (self.parent.path() if self.parent else []) + [self.name]
+
+
+class Reference(object):
+	'''Parses tokens against a spec by clip's documented rules.
+	'''
+
+	def __init__(self, spec):
+		self.root = RefCommand(spec)
+
+	def parse(self, tokens):
+		self.values, self.satisfied = {}, set()
+		self.out, self.err = [], []
+		# Tokens are (token, raw) pairs, where raw tokens may still be expanded
+		return self.parse_command(self.root, [(token, True) for token in tokens])
+
+	def exit(self, message=None, err=False):
+		if message:
+			(self.err if err else self.out).append(message + '\n')
+		raise RefExit(message, 1 if err else 0)
+
+	def expand(self, tokens, i):
+		# -abc --> -a -b -c
+		token, raw = tokens[i]
+		if raw and len(token) > 2 and token.startswith('-') and not token.startswith('--'):
+			tokens[i:i + 1] = [('-' + c, False) for c in token[1:]]
+
+	def value_option(self, cmd, decl):
+		if decl in cmd.opts_map:
+			p = cmd.opts[cmd.opts_map[decl]]
+			if p['nargs'] != 0 and id(p) not in self.satisfied:
+				return p
+		return None
+
+	def parse_command(self, cmd, tokens):
+		parsed = {}
+		if not tokens and cmd.spec['default'] is not None:
+			tokens = [(token, True) for token in cmd.spec['default'].split()]
+		i = 0
+		while i < len(tokens):
+			token, raw = tokens[i]
+			if raw and len(token) > 2 and token.startswith('-') and not token.startswith('--'):
+				# -ovalue gives an option its value, otherwise it is expanded
+				if self.value_option(cmd, token[:2]):
+					tokens[i:i + 1] = [(token[:2], False), (token[2:], False)]
+				else:
+					self.expand(tokens, i)
+				continue
+			if token in cmd.subs:
+				parsed[token] = self.parse_command(cmd.subs[token], tokens[i + 1:])
+				break
+			if token.startswith('--') and '=' in token and token not in cmd.args_map and token not in cmd.opts_map:
+				decl, value = token.split('=', 1)
+				if self.value_option(cmd, decl):
+					tokens[i:i + 1] = [(decl, False), (value, False)]
+					continue
+			match = None
+			if token in cmd.opts_map:
+				p = cmd.opts[cmd.opts_map[token]]
+				if id(p) not in self.satisfied:
+					match = p
+			if match is None:
+				match = next((p for p in cmd.args if id(p) not in self.satisfied), None)
+			if match is None:
+				self.exit('Error: Could not understand "{}".{}'.format(token, self.suggest(cmd, token)), True)
+			if match['kind'] != 'arg':
+				i += 1
+			i = self.consume(cmd, match, tokens, i)
+		for p in cmd.args + cmd.opts:
+			if id(p) not in self.satisfied:
+				if p['required']:
+					self.exit('Error: Missing parameter "{}".'.format(p['name']), True)
+				self.values[id(p)] = p['default']
+		for p in cmd.args + cmd.opts:
+			if not p['hidden'] and (p['name'] in cmd.inherited or not p['inherit_only']):
+				parsed[p['name']] = self.values.get(id(p))
+		return parsed
+
+	def suggest(self, cmd, token):
+		# Compare against every subcommand name and long option, by brute force
+		if len(token) < 3:
+			return ''
+		words = list(cmd.subs) + [d for p in cmd.opts for d in p['decls'] if len(d) > 2]
+		found = sorted((distance(token, w), w) for w in words)
+		if not found or found[0][0] > max(1, len(token) // 3):
+			return ''
+		return ' Did you mean "{}"?'.format(found[0][1])
+
+	def consume(self, cmd, p, tokens, i):
+		if p['kind'] == 'flag':
+			value = True
+		else:
+			value = []
+			while i < len(tokens) and (p['nargs'] == -1 or len(value) < p['nargs']):
+				self.expand(tokens, i)
+				value.append(tokens[i][0])
+				i += 1
+			if p['nargs'] != -1 and len(value) < p['nargs']:
+				self.exit('Error: Not enough arguments for "{}".'.format(p['name']), True)
+			try:
+				value = [p['type'](e) if p['type'] else e for e in value]
+			except ValueError:
+				self.exit('Error: Invalid type given to "{}", expected {}.'.format(
+						p['name'], p['type'].__name__), True)
+			if p['nargs'] == 1:
+				value = value[0]
+		self.values[id(p)] = value
+		self.satisfied.add(id(p))
+		if p.get('callback') == 'help':
+			self.exit(self.help(cmd))
+		if id(p) in cmd.tree_views:
+			self.out.append(self.tree(cmd.tree_views[id(p)]) + '\n')
+			self.exit()
+		return i
+
+	def help(self, cmd):
+		def param_help(p):
+			name = [p['name'] if p['kind'] == 'arg' else ', '.join(p['decls'])]
+			if p['nargs'] != 0:
+				name.append('[{}{}]'.format(p['type'].__name__ if p['type'] else 'text',
+						'' if p['nargs'] == 1 else '...'))
+			desc = [p['help']] if p['help'] is not None else []
+			if p['default']:
+				desc.append('(default: {})'.format(p['default']))
+			return [' '.join(name), ' '.join(desc)]
+		def section(title, data):
+			width = max(len(e[0]) for e in data) + 2
+			return '\n'.join([title] + ['  {}{}'.format(e[0].ljust(width), e[1]).rstrip() for e in data])
+		header = ' '.join(cmd.path())
+		if cmd.spec['description'] is not None:
+			header = '{}: {}'.format(header, cmd.spec['description'])
+		parts, usage = [header], []
+		if cmd.args:
+			usage.append('{{arguments}}')
+			parts.append(section('Arguments:', [param_help(p) for p in cmd.args]))
+		usage.append('{{options}}')
+		parts.append(section('Options:', [param_help(p) for p in cmd.opts]))
+		subs = sorted(cmd.subs.values(), key=lambda e: e.name)
+		if subs:
+			usage.append('{{subcommand}}')
+			parts.append(section('Subcommands:', [[e.name, e.spec['description'] or ''] for e in subs]))
+		parts.insert(1, 'Usage: {} {}'.format(cmd.name, ' '.join(usage)))
+		if cmd.spec['epilogue'] is not None:
+			parts.append(cmd.spec['epilogue'])
+		return '\n\n'.join(parts)
+
+	def tree(self, cmd, depth=0):
+		lines = ['  ' * depth + cmd.name]
+		for sub in sorted(cmd.subs.values(), key=lambda e: e.name):
+			lines.append(self.tree(sub, depth + 1))
+		return '\n'.join(lines)
+
+
+########################################
+# HARNESS
+########################################
+
+def outcome(f, tokens):
+	'''Runs a parse function, returning ('ok', result) or ('exit', status, message).
+	'''
+	try:
+		return ('ok', f(list(tokens)))
+	except (clip.ClipExit, RefExit) as e:
+		return ('exit', e.status, e.message)
+
+def run(iterations=500, seed=0, tokens_per_tree=20):
+	'''Fuzzes App.parse against the reference parser.
+
+	Returns a dict with a list of mismatches (each a dict describing the
+	failing case) and the time taken by every App.parse call.
+	'''
+	rng = random.Random(seed)
+	mismatches, times = [], []
+	for _ in range(iterations):
+		spec = make_spec(rng)
+		app, out, err = build_app(spec)
+		reference = Reference(spec)
+		try:
+			for _ in range(tokens_per_tree):
+				tokens = make_tokens(rng, spec)
+				start = clip.timer()
+				actual = outcome(app.parse, tokens)
+				times.append((clip.timer() - start, tokens))
+				app.reset()
+				actual += (out.text(), err.text())
+				expected = outcome(reference.parse, tokens) + (''.join(reference.out), ''.join(reference.err))
+				if actual != expected:
+					mismatches.append({'spec': spec, 'tokens': tokens, 'actual': actual, 'expected': expected})
+		finally:
+			del clip.clip_globals._streams[app._name]
+	return {'mismatches': mismatches, 'times': times}
+
+def report(times, slowest=5):
+	'''Summarizes a list of (seconds, tokens) parse times.
+	'''
+	times = sorted(times, key=lambda e: e[0])
+	pick = lambda q: times[min(len(times) - 1, int(q * len(times)))][0] * 1e6
+	lines = ['{} parses: p50 {:.1f}us, p90 {:.1f}us, p99 {:.1f}us, max {:.1f}us'.format(
+			len(times), pick(0.5), pick(0.9), pick(0.99), times[-1][0] * 1e6)]
+	lines.append('Slowest inputs:')
+	lines.extend('  {:.1f}us {}'.format(t * 1e6, tokens) for t, tokens in reversed(times[-slowest:]))
+	return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Differentially fuzz clip\'s parser')
+	parser.add_argument('--iterations', type=int, default=2000, help='Number of random trees')
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+	result = run(args.iterations, args.seed)
+	for m in result['mismatches'][:10]:
+		print('MISMATCH for {}:\n  actual   {!r}\n  expected {!r}'.format(m['tokens'], m['actual'], m['expected']))
+	print('{} mismatches'.format(len(result['mismatches'])))
+	print(report(result['times']))
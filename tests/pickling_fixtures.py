@@ -0,0 +1,30 @@
+'''
+Commands and apps that are pickled by the tests, or looked up by name in
+worker processes, and so must live at the top level of a module. They are
+kept out of the tests package itself, so that importing it doesn't register
+any streams.
+'''
+import clip
+
+
+@clip.command()
+@clip.arg('number', nargs=-1, type=int, fanout='process', workers=2)
+def square_all(number):
+	clip.echo(number * number)
+
+
+pickled_app = clip.App(name='pickled', stdout=clip.CaptureStream(), stderr=clip.CaptureStream())
+
+@pickled_app.main(tree_view='tree')
+@clip.opt('-n', type=int, default=1, min=0)
+@clip.flag('--tree')
+def pickled_main(n, tree):
+	clip.echo('main {}'.format(n))
+
+@pickled_main.subcommand()
+@clip.arg('items', nargs=-1, choices=['a', 'b'])
+def pickled_sub(items):
+	clip.echo('sub {}'.format(' '.join(items)))
+
+def run_pickled(app, tokens):
+	return clip.Runner().invoke(app, tokens).stdout
@@ -198,7 +198,7 @@ So long and thanks for all the fish!
 			app.run('--tree')
 		except clip.ClipExit:
 			pass
-		self.assertEqual(out._writes, ['w\n', '  x\n', '    y\n', '      z\n'])
+		self.assertEqual(out._writes, ['w\n  x\n    y\n      z\n'])
 
 	def test_parameters(self):
 		# nargs
@@ -0,0 +1,19 @@
+import os
+
+from . import BaseTest
+from . import fuzz
+
+
+class TestFuzz(BaseTest):
+	'''Checks App.parse against the reference parser in fuzz.py.
+
+	Set CLIP_FUZZ_ITERATIONS for a longer run.
+	'''
+
+	def test_differential(self):
+		iterations = int(os.environ.get('CLIP_FUZZ_ITERATIONS', '200'))
+		result = fuzz.run(iterations, seed=1234)
+		for m in result['mismatches'][:3]:
+			print('Mismatch for {}:\n  actual   {!r}\n  expected {!r}'.format(m['tokens'], m['actual'], m['expected']))
+		self.assertEqual(len(result['mismatches']), 0)
+		self.assertEqual(len(result['times']), iterations * 20)
@@ -0,0 +1,196 @@
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import timeit
+import warnings
+
+import clip
+
+from . import BaseTest, Stream
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'perf-baseline.json')
+
+# How much slower than its baseline a workload may get before failing,
+# e.g. 1.0 allows a workload to take up to twice its baseline time
+TOLERANCE = float(os.environ.get('CLIP_PERF_TOLERANCE', '1.0'))
+
+# Set CLIP_PERF_UPDATE=1 to record new baselines instead of checking them
+UPDATE = os.environ.get('CLIP_PERF_UPDATE') == '1'
+
+
+def best_of(f, repeat=5, number=1):
+	return min(timeit.repeat(f, repeat=repeat, number=number)) / number
+
+def calibrate():
+	'''Times a fixed pure-Python workload, to normalize against machine speed.
+	'''
+	def work():
+		d = {}
+		for i in range(20000):
+			d[str(i)] = [i] * 3
+		return sorted(d, key=len)
+	return best_of(work, repeat=7)
+
+
+class TestPerformance(BaseTest):
+	'''Guards against performance regressions on fixed synthetic trees.
+
+	Each workload is timed relative to a calibration loop and compared to the
+	ratio recorded in perf-baseline.json for the running Python version, so
+	the baselines carry over between machines of different speeds. A Python
+	version without baselines of its own is compared against the nearest
+	version that has them, with a warning.
+	'''
+
+	@classmethod
+	def setUpClass(cls):
+		cls.key = '{}-{}.{}'.format(platform.python_implementation().lower(), *sys.version_info[:2])
+		try:
+			with open(BASELINE_PATH) as f:
+				cls.baselines = json.load(f)
+		except IOError:
+			cls.baselines = {}
+		cls.recorded = cls.find_recorded()
+		cls.unit = calibrate()
+
+	@classmethod
+	def find_recorded(cls):
+		'''Returns the baselines to check against, from the running Python
+		version or else the nearest version of the same implementation.
+		'''
+		if UPDATE or cls.key in cls.baselines:
+			return cls.baselines.get(cls.key, {})
+		def version(key):
+			major, minor = key.split('-')[1].split('.')
+			return int(major) * 100 + int(minor)
+		implementation = cls.key.split('-')[0]
+		keys = [k for k in cls.baselines if k.split('-')[0] == implementation]
+		if not keys:
+			return {}
+		nearest = min(keys, key=lambda k: abs(version(k) - version(cls.key)))
+		warnings.warn('No performance baselines recorded for {}, so checking against those of {}. '
+			'Record them with CLIP_PERF_UPDATE=1.'.format(cls.key, nearest), RuntimeWarning)
+		return cls.baselines[nearest]
+
+	@classmethod
+	def tearDownClass(cls):
+		if UPDATE:
+			with open(BASELINE_PATH, 'w') as f:
+				json.dump(cls.baselines, f, indent=2, sort_keys=True)
+				f.write('\n')
+
+	def check(self, name, seconds):
+		ratio = seconds / self.unit
+		if UPDATE:
+			self.baselines.setdefault(self.key, {})[name] = round(ratio, 4)
+			return
+		baseline = self.recorded.get(name)
+		if baseline is None:
+			self.fail('No {} baseline recorded for {}, record one with CLIP_PERF_UPDATE=1'.format(name, self.key))
+		self.assertLessEqual(ratio, baseline * (1 + TOLERANCE),
+			'{} regressed: {:.3f} vs baseline {:.3f} (calibration units)'.format(name, ratio, baseline))
+
+	def make_tree(self, width=50, params=5):
+		app = clip.App(stdout=Stream(), stderr=Stream())
+
+		@app.main()
+		@clip.flag('-v', '--verbose')
+		@clip.opt('-c', '--config')
+		def main(verbose, config):
+			pass
+
+		for i in range(width):
+			def sub(**kwargs):
+				pass
+			for j in range(params):
+				clip.opt('--opt{}'.format(j), type=int, default=0)(sub)
+			clip.arg('items', nargs=-1)(sub)
+			main.subcommand(name='sub{}'.format(i))(sub)
+		return app
+
+	def test_construction(self):
+		self.check('construction', best_of(self.make_tree))
+
+	def test_parse(self):
+		app = self.make_tree()
+		tokens = ['-v', 'sub25', '--opt1', '4', '--opt3', '2', 'a', 'b', 'c']
+		def run():
+			for _ in range(200):
+				app.parse(list(tokens))
+				app.reset()
+		self.check('parse', best_of(run))
+
+	def test_help(self):
+		app = clip.App(stdout=Stream(), stderr=Stream())
+
+		@app.main(description='Lots of options')
+		def f(**kwargs):
+			pass
+
+		for i in range(300):
+			clip.opt('--option-{}'.format(i), help='Option number {}'.format(i))(f)
+			f.subcommand(name='sub{}'.format(i), description='Subcommand {}'.format(i))(lambda: None)
+		def run():
+			try:
+				app.run('-h')
+			except clip.ClipExit:
+				pass
+		self.check('help', best_of(run))
+
+	def test_import(self):
+		# A single import is noisy, so take the best of a few
+		times = []
+		for _ in range(3):
+			try:
+				out = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import clip'],
+					stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+			except (subprocess.CalledProcessError, OSError):
+				self.skipTest('Import times are not available')
+			match = re.search(r'\|\s*(\d+)\s*\|\s*clip$', out.decode(), re.M)
+			if match is None:
+				self.skipTest('Import times are not available')
+			times.append(int(match.group(1)) / 1e6)
+		self.check('import', min(times))
+
+	def scaling(self, f, n):
+		'''Returns how much slower f gets when its input size doubles.
+		'''
+		small, large = [], []
+		for _ in range(5):
+			small.append(best_of(lambda: f(n), repeat=1))
+			large.append(best_of(lambda: f(2 * n), repeat=1))
+		return min(large) / min(small)
+
+	def test_parse_scaling(self):
+		# Parsing must stay linear in the number of tokens: a quadratic
+		# algorithm would take about 4 times as long on twice the input
+		def many_args(n):
+			app = clip.App(stdout=Stream(), stderr=Stream())
+
+			@app.main()
+			@clip.arg('items', nargs=-1)
+			def f(items):
+				pass
+
+			app.parse(['x'] * n)
+
+		def many_opts(n):
+			app = clip.App(stdout=Stream(), stderr=Stream())
+
+			@app.main()
+			def f(**kwargs):
+				pass
+
+			for i in range(n):
+				clip.opt('--o{}'.format(i))(f)
+			tokens = []
+			for i in range(n):
+				tokens += ['--o{}'.format(i), 'x']
+			app.parse(tokens)
+
+		for f, n in [(many_args, 50000), (many_opts, 5000)]:
+			self.assertLess(self.scaling(f, n), 3.0)